@@ -0,0 +1,468 @@
+# coding: utf-8
+"""Wall time, HTTP requests and peak memory of fct commands
+
+Redmine, Gitlab and Jenkins are replaced by local threaded HTTP servers,
+which reply with generated payloads after a configurable latency,
+so runs are offline and repeatable. Every run is a fresh interpreter
+with its own HOME (.fabricrc and toolbelt cache), caches are cold
+unless --warm is given. Commits for tickets are generated in a temp repo.
+
+Commands: tickets, tickets-by-ids, gitlab-assign, redmine-assign, jenkins-create-job
+
+Run it as ``python benchmarks/commands.py`` from repo root.
+
+usage:
+    commands.py [options] [<command>...]
+
+options:
+    --latency=<ms>      Delay of every stand-in response [default: 50]
+    --issues=<n>        Redmine issues, each mentioned in a commit [default: 3000]
+    --users=<n>         Redmine and Gitlab users [default: 500]
+    --projects=<n>      Gitlab projects [default: 300]
+    --members=<n>       Memberships assigned by assign commands [default: 50]
+    --jobs=<n>          Jenkins jobs created [default: 30]
+    --repeat=<n>        Runs per command, best one is reported [default: 3]
+    --warm              Keep caches between runs of a command
+    --save=<file>       Save results as JSON
+    --compare=<file>    Compare with results saved earlier
+"""
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from docopt import docopt
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+except ImportError:  # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN_CLI = "import sys; sys.argv = ['fct'] + %r; from fc_toolbelt.cli import main; main()"
+WORDS = ('user', 'profile', 'page', 'cache', 'login', 'report', 'export', 'search', 'form', 'email',
+         'payment', 'order', 'admin', 'api', 'mobile', 'layout', 'upload', 'image', 'slow', 'broken')
+JOB_TEMPLATES = ('example-tests', 'example-lint', 'example-deploy')
+
+COMMANDS = {
+    'tickets': ['tickets', 'bench', '--from=^master$', '--to=^dev$'],
+    'tickets-by-ids': ['tickets', 'bench', '--from=^master$', '--to=^dev$', '--by_ids'],
+    'gitlab-assign': ['gitlab', 'assign', '--csv=members.csv'],
+    'redmine-assign': ['redmine', 'assign', '--csv=members.csv'],
+    'jenkins-create-job': ['jenkins', 'create_job', '--csv=jobs.csv'],
+}
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """ Local HTTP server, which passes requests to app after latency"""
+    daemon_threads = True
+
+    def __init__(self, app, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.app = app
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_port
+
+    def reset(self):
+        self.requests = 0
+        self.app.reset()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like real servers
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        with self.server.lock:
+            self.server.requests += 1
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.server.latency)
+
+        status, headers, payload = self.server.app.dispatch(method, url.path, dict(parse_qsl(url.query)), body)
+        if not isinstance(payload, (str, bytes)):
+            payload = json.dumps(payload)
+            headers.setdefault('Content-Type', 'application/json')
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class App(object):
+    """ Routes are (method, path regexp, handler name), handler gets query, body and path groups"""
+    routes = ()
+
+    def reset(self):
+        pass
+
+    def dispatch(self, method, path, query, body):
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern + '$', path)
+            if route_method == method and match:
+                return getattr(self, handler)(query, body, *match.groups())
+        return 404, {}, ''
+
+
+def make_users(count, rng):
+    users = []
+    for index in range(1, count + 1):
+        firstname, lastname = rng.choice(WORDS).title(), rng.choice(WORDS).title()
+        users.append({'id': index, 'login': 'user%04d' % index, 'firstname': firstname, 'lastname': lastname,
+                      'mail': 'user%04d@example.com' % index,
+                      'created_on': '2012-%02d-%02dT10:00:00Z' % (rng.randint(1, 12), rng.randint(1, 28)),
+                      'last_login_on': '2013-%02d-%02dT10:00:00Z' % (rng.randint(1, 7), rng.randint(1, 28))})
+    return users
+
+
+class Redmine(App):
+    routes = (
+        ('GET', r'/issues\.json', 'issues_page'),
+        ('GET', r'/issues/(\d+)\.json', 'issue'),
+        ('GET', r'/users\.json', 'users_page'),
+        ('POST', r'/projects/([^/]+)/memberships\.json', 'add_membership'),
+    )
+    MAX_LIMIT = 100
+
+    def __init__(self, issues_count, users, rng):
+        self.users = users
+        statuses = [{'id': 1, 'name': 'New'}, {'id': 2, 'name': 'In Progress'}, {'id': 5, 'name': 'Closed'}]
+        self.issues = []
+        for index in range(1, issues_count + 1):
+            author, assignee = rng.choice(users), rng.choice(users)
+            self.issues.append({
+                'id': index,
+                'project': {'id': 1, 'name': 'Bench'},
+                'tracker': {'id': 1, 'name': rng.choice(['Bug', 'Feature', 'Support'])},
+                'status': rng.choice(statuses),
+                'priority': {'id': 4, 'name': 'Normal'},
+                'author': {'id': author['id'], 'name': author['firstname']},
+                'assigned_to': {'id': assignee['id'], 'name': assignee['firstname']},
+                'subject': ' '.join(rng.choice(WORDS) for _ in range(6)).capitalize(),
+                'description': ' '.join(rng.choice(WORDS) for _ in range(60)),
+                'start_date': '2013-01-01',
+                'done_ratio': rng.choice([0, 30, 100]),
+                'created_on': '2013-01-01T10:00:00Z',
+                'updated_on': '2013-%02d-%02dT10:00:00Z' % (rng.randint(1, 7), rng.randint(1, 28)),
+            })
+        self.issues_by_id = dict((str(issue['id']), issue) for issue in self.issues)
+
+    def page(self, key, objects, query):
+        offset = int(query.get('offset', 0))
+        limit = min(int(query.get('limit', 25)), self.MAX_LIMIT)
+        return 200, {}, {key: objects[offset:offset + limit], 'total_count': len(objects),
+                         'offset': offset, 'limit': limit}
+
+    def issues_page(self, query, body):
+        issues = self.issues
+        if query.get('issue_id'):
+            issues = [self.issues_by_id[issue_id] for issue_id in query['issue_id'].split(',')
+                      if issue_id in self.issues_by_id]
+        if query.get('updated_on', '').startswith('>='):
+            issues = [issue for issue in issues if issue['updated_on'] >= query['updated_on'][2:]]
+        return self.page('issues', issues, query)
+
+    def issue(self, query, body, issue_id):
+        if issue_id not in self.issues_by_id:
+            return 404, {}, ''
+        return 200, {}, {'issue': self.issues_by_id[issue_id]}
+
+    def users_page(self, query, body):
+        return self.page('users', self.users, query)
+
+    def add_membership(self, query, body, project_slug):
+        return 201, {}, {'membership': dict(json.loads(body)['membership'], project={'name': project_slug})}
+
+
+class Gitlab(App):
+    routes = (
+        ('GET', r'/api/v3/users', 'users_page'),
+        ('GET', r'/api/v3/projects', 'projects_page'),
+        ('POST', r'/api/v3/projects/([^/]+)/members', 'add_member'),
+    )
+
+    def __init__(self, users, projects_count, rng):
+        self.users = [{'id': user['id'], 'username': user['login'], 'email': user['mail'],
+                       'name': '%s %s' % (user['firstname'], user['lastname']), 'state': 'active',
+                       'blocked': False, 'created_at': user['created_on'], 'bio': None, 'skype': '',
+                       'linkedin': '', 'twitter': '', 'theme_id': 2, 'color_scheme_id': 1}
+                      for user in users]
+        self.projects = []
+        for index in range(1, projects_count + 1):
+            path = 'project-%04d' % index
+            owner = rng.choice(self.users)
+            self.projects.append({
+                'id': index, 'name': path.title(), 'code': path, 'path': path,
+                'path_with_namespace': 'fc/%s' % path,
+                'description': ' '.join(rng.choice(WORDS) for _ in range(12)),
+                'default_branch': 'dev', 'public': False,
+                'owner': {'id': owner['id'], 'username': owner['username'], 'email': owner['email'],
+                          'name': owner['name'], 'state': 'active', 'created_at': owner['created_at']},
+                'namespace': {'id': 1, 'name': 'fc', 'path': 'fc', 'owner_id': 1},
+                'ssh_url_to_repo': 'git@gitlab.example.com:fc/%s.git' % path,
+                'http_url_to_repo': 'http://gitlab.example.com/fc/%s.git' % path,
+                'web_url': 'http://gitlab.example.com/fc/%s' % path,
+                'issues_enabled': True, 'merge_requests_enabled': True, 'wall_enabled': False,
+                'wiki_enabled': True, 'snippets_enabled': False,
+                'created_at': '2013-01-01T10:00:00Z', 'last_activity_at': '2013-07-01T10:00:00Z',
+            })
+
+    def page(self, objects, query):
+        page, per_page = int(query.get('page', 1)), int(query.get('per_page', 20))
+        total_pages = (len(objects) + per_page - 1) // per_page
+        return 200, {'X-Total': str(len(objects)), 'X-Total-Pages': str(total_pages)}, \
+            objects[(page - 1) * per_page:page * per_page]
+
+    def users_page(self, query, body):
+        return self.page(self.users, query)
+
+    def projects_page(self, query, body):
+        return self.page(self.projects, query)
+
+    def add_member(self, query, body, project_id):
+        fields = dict(parse_qsl(body.decode('utf-8') if isinstance(body, bytes) else body))
+        return 201, {}, {'id': int(fields['user_id']), 'access_level': int(fields['access_level'])}
+
+
+class Jenkins(App):
+    routes = (
+        ('GET', r'/crumbIssuer/api/json', 'crumb'),
+        ('GET', r'/job/([^/]+)/config\.xml', 'config'),
+        ('POST', r'/createItem', 'create_item'),
+        ('POST', r'/job/([^/]+)/build', 'build'),
+    )
+    CONFIG = """<?xml version='1.0' encoding='UTF-8'?>
+<project>
+  <description>%(kind)s of {project}</description>
+  <keepDependencies>false</keepDependencies>
+  <properties/>
+  <scm class="hudson.plugins.git.GitSCM">
+    <configVersion>2</configVersion>
+    <userRemoteConfigs>
+      <hudson.plugins.git.UserRemoteConfig>
+        <url>git@gitlab.example.com:fc/{project}.git</url>
+      </hudson.plugins.git.UserRemoteConfig>
+    </userRemoteConfigs>
+    <branches><hudson.plugins.git.BranchSpec><name>dev</name></hudson.plugins.git.BranchSpec></branches>
+  </scm>
+  <canRoam>true</canRoam>
+  <disabled>true</disabled>
+  <triggers class="vector"><hudson.triggers.SCMTrigger><spec>*/5 * * * *</spec></hudson.triggers.SCMTrigger></triggers>
+  <concurrentBuild>false</concurrentBuild>
+  <builders>
+    <hudson.tasks.Shell>
+      <command>virtualenv env &amp;&amp; env/bin/pip install -r requirements.txt
+env/bin/python manage.py %(kind)s --settings={project}.settings.test</command>
+    </hudson.tasks.Shell>
+  </builders>
+  <publishers/>
+  <buildWrappers/>
+</project>
+"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.jobs = set()
+        self.queue = 0
+
+    def crumb(self, query, body):
+        return 200, {}, {'crumbRequestField': 'Jenkins-Crumb', 'crumb': 'bench'}
+
+    def config(self, query, body, job_name):
+        if job_name not in JOB_TEMPLATES:
+            return 404, {}, ''
+        return 200, {'Content-Type': 'application/xml'}, self.CONFIG % {'kind': job_name.split('-')[-1]}
+
+    def create_item(self, query, body):
+        if query['name'] in self.jobs:
+            return 400, {'X-Error': 'A job already exists with the name %s' % query['name']}, ''
+        self.jobs.add(query['name'])
+        return 200, {}, ''
+
+    def build(self, query, body, job_name):
+        self.queue += 1
+        return 201, {'Location': '/queue/item/%s/' % self.queue}, ''
+
+
+def make_repo(path, issues_count):
+    """ dev branch and master with a commit mentioning every issue, via fast-import"""
+    commits = ['commit refs/heads/dev', 'mark :1', 'committer Bench <bench@example.com> 1370000000 +0000',
+               'data 14', 'Initial commit', 'M 644 inline README', 'data 5', 'bench', '',
+               'reset refs/heads/master', 'from :1', '']
+    for issue_id in range(1, issues_count + 1):
+        message = 'Fixed %s. Fixes #%s' % (WORDS[issue_id % len(WORDS)], issue_id)
+        commits += ['commit refs/heads/master',
+                    'committer Bench <bench@example.com> %s +0000' % (1370000000 + issue_id),
+                    'data %s' % len(message), message, '']
+    subprocess.check_call(['git', 'init', '-q', path])
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    process.communicate(('\n'.join(commits) + '\n').encode('utf-8'))
+    subprocess.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=path)
+    subprocess.check_call(['git', 'reset', '-q', '--hard'], cwd=path)
+
+
+def write_data(data_dir, options, users, projects):
+    members = int(options['--members'])
+    with open(os.path.join(data_dir, 'members.csv'), 'w') as members_file:
+        for index in range(members):
+            members_file.write('%s,%s\n' % (projects[index % len(projects)]['path'], users[index % len(users)]['mail']))
+    with open(os.path.join(data_dir, 'jobs.csv'), 'w') as jobs_file:
+        for index in range(int(options['--jobs'])):
+            template = JOB_TEMPLATES[index % len(JOB_TEMPLATES)]
+            project = projects[index // len(JOB_TEMPLATES) % len(projects)]['path']
+            jobs_file.write('%s,%s-%s,%s\n' % (project, project, template.split('-')[-1], template))
+
+
+def make_home(work_dir, servers):
+    home = tempfile.mkdtemp(prefix='home-', dir=work_dir)
+    settings = {
+        'REDMINE_URL': servers['redmine'].url,
+        'REDMINE_API_KEY': 'bench',
+        'REDMINE_DEVELOPER_ROLE_ID': '4',
+        'GITLAB_URL': servers['gitlab'].url,
+        'GITLAB_TOKEN': 'bench',
+        'JENKINS_URL': servers['jenkins'].url,
+        'JENKINS_LOGIN': 'bench',
+        'JENKINS_PASSWORD': 'bench',
+        'TOOLBELT_CACHE_DIR': os.path.join(home, '.fc_toolbelt'),
+    }
+    with open(os.path.join(home, '.fabricrc'), 'w') as fabricrc:
+        fabricrc.write(''.join('%s = %s\n' % item for item in sorted(settings.items())))
+    return home
+
+
+def run_command(argv, cwd, home, log_path):
+    """ (ok, seconds, peak RSS in MB) of fct run in a fresh interpreter"""
+    environ = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join(
+        filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    with open(log_path, 'a') as log_file:
+        started = time.time()
+        process = subprocess.Popen([sys.executable, '-c', RUN_CLI % argv], cwd=cwd, env=environ,
+                                   stdin=open(os.devnull), stdout=log_file, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        seconds = time.time() - started
+    return process.returncode == 0, seconds, usage.ru_maxrss / 1024.0  # KB on Linux
+
+
+def benchmark(command, options, servers, work_dir):
+    repo_dir = os.path.join(work_dir, 'repo')
+    cwd = repo_dir if command.startswith('tickets') else work_dir
+    log_path = os.path.join(work_dir, '%s.log' % command)
+    index_path = os.path.join(repo_dir, '.git', 'fc_toolbelt_tickets.json')
+    home, runs = None, []
+    for _ in range(int(options['--repeat'])):
+        if home is None or not options['--warm']:
+            if home:
+                shutil.rmtree(home)
+            home = make_home(work_dir, servers)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+        for server in servers.values():
+            server.reset()
+        ok, seconds, peak_mb = run_command(COMMANDS[command], cwd, home, log_path)
+        if not ok:
+            with open(log_path) as log_file:
+                sys.exit('%s failed:\n%s' % (command, ''.join(log_file.readlines()[-20:])))
+        runs.append({'seconds': seconds, 'peak_mb': peak_mb,
+                     'requests': sum(server.requests for server in servers.values())})
+    best = min(runs, key=lambda run: run['seconds'])
+    best['peak_mb'] = max(run['peak_mb'] for run in runs)
+    return best
+
+
+def compare(results, saved):
+    print('')
+    print('%-20s %18s %18s %18s' % ('compared to saved', 'wall time', 'requests', 'peak memory'))
+    for command in sorted(results):
+        if command not in saved:
+            continue
+        changes = []
+        for key in ('seconds', 'requests', 'peak_mb'):
+            old, new = saved[command][key], results[command][key]
+            changes.append('%+.1f%%' % ((new - old) * 100.0 / old) if old else 'n/a')
+        print('%-20s %18s %18s %18s' % tuple([command] + changes))
+
+
+def main():
+    options = docopt(__doc__)
+    commands = options['<command>'] or sorted(COMMANDS)
+    unknown = set(commands) - set(COMMANDS)
+    if unknown:
+        sys.exit('Unknown commands: %s' % ', '.join(sorted(unknown)))
+
+    rng = random.Random(42)
+    users = make_users(int(options['--users']), rng)
+    latency = float(options['--latency']) / 1000
+    apps = {
+        'redmine': Redmine(int(options['--issues']), users, rng),
+        'gitlab': Gitlab(users, int(options['--projects']), rng),
+        'jenkins': Jenkins(),
+    }
+    servers = dict((name, StandInServer(app, latency).start()) for name, app in apps.items())
+
+    work_dir = tempfile.mkdtemp(prefix='fct-bench-')
+    try:
+        make_repo(os.path.join(work_dir, 'repo'), int(options['--issues']))
+        write_data(work_dir, options, users, apps['gitlab'].projects)
+
+        results = {}
+        print('%-20s %12s %10s %12s' % ('command', 'wall time', 'requests', 'peak memory'))
+        for command in commands:
+            results[command] = benchmark(command, options, servers, work_dir)
+            print('%-20s %10.2f s %10d %9.1f MB' % (command, results[command]['seconds'],
+                                                     results[command]['requests'], results[command]['peak_mb']))
+    finally:
+        shutil.rmtree(work_dir)
+        for server in servers.values():
+            server.shutdown()
+
+    if options['--compare']:
+        with open(options['--compare']) as saved_file:
+            compare(results, json.load(saved_file)['results'])
+    if options['--save']:
+        settings = dict((key.lstrip('-'), value) for key, value in options.items() if key.startswith('--')
+                        and key not in ('--save', '--compare'))
+        with open(options['--save'], 'w') as saved_file:
+            json.dump({'python': sys.version.split()[0], 'options': settings, 'results': results},
+                      saved_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
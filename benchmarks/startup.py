@@ -0,0 +1,76 @@
+# coding: utf-8
+"""Startup time of fct commands
+
+Every measurement runs in a fresh interpreter:
+
+* ``fct --version`` and ``fct help`` end to end
+* import of ``fc_toolbelt.cli`` plus modules imported by each command
+
+Run it as ``python benchmarks/startup.py`` from repo root.
+
+usage:
+    startup.py [--repeat=<n>] [--max-ms=<ms>]
+
+options:
+    --repeat=<n>    Runs per measurement, best one is reported [default: 5]
+    --max-ms=<ms>   Exit with error if fct help is slower than that
+"""
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+
+# Keep in sync with imports inside fc_toolbelt.cli commands
+COMMAND_MODULES = {
+    'boilerplate': ['fc_toolbelt.tasks.project'],
+    'config': ['fc_toolbelt.tasks.setup'],
+    'git': ['fc_toolbelt.tasks.git'],
+    'gitlab': ['fc_toolbelt.tasks.gitlab'],
+    'jenkins': ['fc_toolbelt.tasks.jenkins'],
+    'join': ['fc_toolbelt.tasks.project'],
+    'redmine': ['fc_toolbelt.tasks.redmine'],
+    'tickets': ['fc_toolbelt.tasks.tickets'],
+    'update': ['fc_toolbelt.tasks.django'],
+}
+
+RUN_CLI = "import sys; sys.argv = ['fct'] + %r; from fc_toolbelt.cli import main; main()"
+IMPORT_MODULES = ("import time; started = time.time(); import fc_toolbelt.cli; import %s; "
+                  "print(time.time() - started)")
+
+
+def best_wall_time(code, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.time()
+        subprocess.call([sys.executable, '-c', code], stdout=open('/dev/null', 'w'), stderr=subprocess.STDOUT)
+        times.append(time.time() - started)
+    return min(times)
+
+
+def best_import_time(modules, repeat):
+    return min(float(subprocess.check_output([sys.executable, '-c', IMPORT_MODULES % ', '.join(modules)]))
+               for _ in range(repeat))
+
+
+def main():
+    options = docopt(__doc__)
+    repeat = int(options['--repeat'])
+
+    baseline = best_wall_time('pass', repeat)
+    print('%-24s %8.1f ms' % ('python itself', baseline * 1000))
+    help_time = best_wall_time(RUN_CLI % ['help'], repeat) - baseline
+    for name, argv in [('fct --version', ['--version']), ('fct help', ['help'])]:
+        elapsed = help_time if argv == ['help'] else best_wall_time(RUN_CLI % argv, repeat) - baseline
+        print('%-24s %8.1f ms' % (name, elapsed * 1000))
+    for command in sorted(COMMAND_MODULES):
+        print('%-24s %8.1f ms' % ('fct %s imports' % command,
+                                  best_import_time(COMMAND_MODULES[command], repeat) * 1000))
+
+    if options['--max-ms'] and help_time * 1000 > float(options['--max-ms']):
+        sys.exit('fct help takes %.1f ms, more than %s ms' % (help_time * 1000, options['--max-ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,30 +36,48 @@ options:
   --target_id=<target_id>   ## tickets command ##
   --urls                    ## tickets command ##
   --by_ids                  ## tickets command ##
+  --no_batch                ## tickets command ##
+  --concurrency=<n>         ## tickets command ##
+  --no_cache                ## tickets command ##
+  --clear_cache             ## tickets command ##
+  --cache_size=<n>          ## tickets command ##
+  --patterns=<patterns>     ## tickets command ##
+  --no_index                ## tickets command ##
+  --projects=<slugs>        ## gitlab, redmine commands ##
+  --emails=<emails>         ## gitlab, redmine commands ##
+  --csv=<file>              ## gitlab, redmine, jenkins commands ##
+  --remotes=<names>         ## git command ##
+  --base=<branch>           ## git command ##
+  --protected=<names>       ## git command ##
+  --dry-run                 ## git command ##
+  --wait                    ## jenkins command ##
 
 See 'fct help <command>' for more information on a specific command.
 """
+import csv
+import itertools
 import logging
 import sys
 import textwrap
 
 from docopt import docopt
-from fabric import state
-from fabric.main import load_settings
-from fabric.tasks import execute
 
 import fc_toolbelt
-from fc_toolbelt.tasks import django, setup
-from fc_toolbelt.tasks.git import prune
-from fc_toolbelt.tasks.gitlab import create_repo, assign
-from fc_toolbelt.tasks.jenkins import create_job
-from fc_toolbelt.tasks.project import open_tin, add_developer
-from fc_toolbelt.tasks.redmine import create_project, assign_permissions
-from fc_toolbelt.tasks.tickets import diff_tickets
 
 
 logger = logging.getLogger('fc_toolbelt')
 
+# Task modules (fabric, requests, jinja) are imported by commands
+# themselves, so that help and light commands start fast (see benchmarks/startup.py)
+COMMANDS_WITHOUT_SETTINGS = ['git']
+
+
+def load_fabric_settings():
+    """ Load fabric defaults from ~/.fabricrc"""
+    from fabric import state
+    from fabric.main import load_settings
+    state.env.update(load_settings(state._rc_path()))
+
 
 def main():
     # Let's print help be default
@@ -70,18 +88,18 @@ def main():
                           'redmine', 'tickets', 'update']
     command = options['<command>']
 
-    # Load fabric defaults from ~/.fabricrc
-    state.env.update(load_settings(state._rc_path()))
-
     if True or options['--verbose']:
         level = logging.DEBUG if options['--verbose'] else logging.INFO
         logger.addHandler(logging.StreamHandler())
         logger.setLevel(level)
     else:
+        from fabric import state
         state.output['commands'] = False
         state.env.output_prefix = False
 
     if options['<command>'] in available_commands:
+        if command not in COMMANDS_WITHOUT_SETTINGS:
+            load_fabric_settings()
         subcommand = globals()[command]
         options = docopt(subcommand.__doc__, argv=sys.argv[1:])
         exit(subcommand(options))
@@ -100,27 +118,49 @@ def update(options):
        Update code, install packages, sync/migrate and reload.
 
        Usage:
-           fct update
+           fct update [--force]
 
        * update current git repo (pull)
-       * install latest packages fro requirements.txt
-       * update database (syncdb & migrate)
-       * reload uwsgi instance
+       * install latest packages fro requirements.txt, if requirements files changed
+       * update database (syncdb & migrate), if pulled commits changed models or migrations
+       * reload uwsgi instance, if anything changed
+
+       Skipped steps are reported with time they took last time,
+       use --force to run every step anyway.
     """
-    execute(django.update)
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks import django
+    execute(django.update, force=options['--force'])
 
 
 def git(options):
     """
        No need to make own aliases for git commands.
 
-       * Remove old branches from origin
+       * Remove branches merged into master from origin (or other remotes)
+
+       Merged branches are listed first and deleted after confirmation,
+       protected branches are read from git config fct.protected
+       (e.g. git config fct.protected dev,master,stable).
 
        Usage:
-          fct git prune
+          fct git prune [--remotes=<names>] [--base=<branch>] [--protected=<names>] [--dry-run] [--force]
+
+       Options:
+          --remotes=<names>      Comma-separated remotes to prune [default: origin]
+          --base=<branch>        Branch that others are merged into [default: master]
+          --protected=<names>    Comma-separated branches to keep, overrides git config
+          --dry-run              Only list merged branches
+          --force                Don't ask for confirmation
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.git import prune
     if options['prune']:
-        execute(prune)
+        execute(prune, remotes=options['--remotes'].split(','),
+                       base=options['--base'],
+                       protected=options['--protected'] and options['--protected'].split(','),
+                       dry_run=options['--dry-run'],
+                       force=options['--force'])
 
 
 def gitlab(options):
@@ -130,33 +170,77 @@ def gitlab(options):
        Creating repo
          Creates repo by name, does not assign any teams.
        Assign members
-         Assigns 1 member to project with default developer role.
+         Assigns members to projects with default developer role.
+         Every email from --emails is assigned to every project from --projects,
+         also "project_slug,user_email" lines are read from --csv file (- for stdin).
 
        Usage:
           fct gitlab create_repo <project_slug>
           fct gitlab assign <project_slug> <user_email>
+          fct gitlab assign [--projects=<slugs> --emails=<emails>] [--csv=<file>]
+
+       Options:
+          --projects=<slugs>    Comma-separated project slugs
+          --emails=<emails>     Comma-separated user emails
+          --csv=<file>          CSV file with project_slug,user_email lines
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.gitlab import create_repo, assign
     if options['create_repo']:
         execute(create_repo, project_slug=options['<project_slug>'])
     elif options['assign']:
-        execute(assign, project_slug=options['<project_slug>'], user_email=options['<user_email>'])
+        execute(assign, assignments=get_assignments(options))
+
+
+def get_assignments(options):
+    """ (project_slug, user_email) pairs from positional args, --projects/--emails and --csv"""
+    if options.get('<project_slug>'):
+        return [(options['<project_slug>'], options['<user_email>'])]
+    split = lambda value: [item.strip() for item in (value or '').split(',') if item.strip()]
+    assignments = list(itertools.product(split(options.get('--projects')), split(options.get('--emails'))))
+    if options.get('--csv'):
+        csv_file = sys.stdin if options['--csv'] == '-' else open(options['--csv'])
+        assignments += [(row[0].strip(), row[1].strip()) for row in csv.reader(csv_file) if len(row) >= 2]
+    if not assignments:
+        exit('Nothing to assign, provide projects and emails.')
+    return assignments
 
 
 def jenkins(options):
     """
        Shortcuts to create jobs in jenkins.
 
-       Template job is copied and templated ({{project}} is replaced with project slug).
-       It's enabled after that and executed.
+       Template job config is templated ({project} is replaced with project slug),
+       job is created with it enabled and executed.
+       Many jobs are created at once from "project_slug,job_name[,template_job]"
+       lines of --csv file (- for stdin), every template config is downloaded once.
+       With --wait, console logs of triggered builds are streamed,
+       command fails unless all builds succeed.
 
        Usage:
-          fct jenkins create_job <project_slug> <job_name> [<template_job>]
+          fct jenkins create_job <project_slug> <job_name> [<template_job>] [--wait]
+          fct jenkins create_job --csv=<file> [--wait]
+
+       Options:
+          --csv=<file>          CSV file with project_slug,job_name[,template_job] lines
+          --wait                Wait for builds to finish, stream their logs
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.jenkins import create_job
     if options['create_job']:
-        execute(create_job,
-                job_name=options['<job_name>'],
-                project_slug=options['<project_slug>'],
-                template_job=options['<template_job>'])
+        execute(create_job, jobs=get_jobs(options), wait=options['--wait'])
+
+
+def get_jobs(options):
+    """ (project_slug, job_name, template_job) from positional args or --csv"""
+    if options.get('<project_slug>'):
+        return [(options['<project_slug>'], options['<job_name>'], options['<template_job>'])]
+    csv_file = sys.stdin if options['--csv'] == '-' else open(options['--csv'])
+    jobs = [(row[0].strip(), row[1].strip(), row[2].strip() if len(row) > 2 and row[2].strip() else None)
+            for row in csv.reader(csv_file) if len(row) >= 2]
+    if not jobs:
+        exit('Nothing to create, provide project_slug,job_name lines.')
+    return jobs
 
 
 def config(options):
@@ -181,6 +265,8 @@ def config(options):
         Options:
             -f --force     Ignore existing setup of toolbelt and reconfigure.
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks import setup
     execute(setup.config, force=options.get('--force', False))
 
 
@@ -188,18 +274,27 @@ def redmine(options):
     """
        Shortcuts to create projects and assign developers in Redmine.
 
+       Every email from --emails is assigned to every project from --projects,
+       also "project_slug,user_email" lines are read from --csv file (- for stdin).
+
        Usage:
           fct redmine create_project <project_slug> [<project_name>]
           fct redmine assign <project_slug> <user_email>
+          fct redmine assign [--projects=<slugs> --emails=<emails>] [--csv=<file>]
+
+       Options:
+          --projects=<slugs>    Comma-separated project slugs
+          --emails=<emails>     Comma-separated user emails
+          --csv=<file>          CSV file with project_slug,user_email lines
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.redmine import create_project, assign_permissions
     if options['create_project']:
         execute(create_project,
                 project_slug=options['<project_slug>'],
                 project_name=options.get('<project_name>', None))
     elif options['assign']:
-        execute(assign_permissions,
-                project_slug=options['<project_slug>'],
-                user_email=options['<user_email>'])
+        execute(assign_permissions, assignments=get_assignments(options))
 
 
 def tickets(options):
@@ -236,7 +331,18 @@ def tickets(options):
           --status                  Issue status from Redmine query results
           --full                    Full info from Redmine query results
           --by_ids                  Get results from Redmine by ticket ids list
+          --no_batch                With --by_ids request tickets one by one
+          --concurrency=<n>         Number of parallel Redmine requests (REDMINE_CONCURRENCY, 8 by default)
+          --no_cache                With --by_ids bypass local cache of Redmine issues
+          --clear_cache             With --by_ids drop local cache of Redmine issues before querying
+          --cache_size=<n>          Max issues in local cache (REDMINE_CACHE_SIZE, 5000 by default)
+          --patterns=<patterns>     Comma-separated ticket patterns in commit messages:
+                                    bare (#N), refs (refs #N), fixes (fixes #N) or regexps
+                                    (TICKET_PATTERNS, bare by default)
+          --no_index                Scan all commit messages instead of using commit-to-ticket index
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.tickets import diff_tickets
     kwargs = {
         'project_id': options['<project_slug>'],
     }
@@ -249,6 +355,13 @@ def tickets(options):
         '--status': 'status',
         '--full': 'full',
         '--by_ids': 'by_ids',
+        '--no_batch': 'no_batch',
+        '--concurrency': 'concurrency',
+        '--no_cache': 'no_cache',
+        '--clear_cache': 'clear_cache',
+        '--cache_size': 'cache_size',
+        '--patterns': 'patterns',
+        '--no_index': 'no_index',
     }
     for arg in mapping.keys():
         if options.get(arg):
@@ -265,21 +378,31 @@ def join(options):
        * configures webserver for local development (ngnix+uwsgi)
        * sets up database <project>_<developer>
 
+       Several projects and developers can be given comma-separated,
+       every developer joins every project, nginx is reloaded once.
+
        Usage:
           fct join [options] <project_slug> <developer>
 
+       Example:
+          fct join futurecolors,tinned alice,bob
+
        Options:
           --verbose                  Show debug information
           --uwsgi-config=<config>    Change default uwsgi template
           --python=<version>         Change default python version
     """
+    from fabric import state
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.project import add_developers
     if options['join']:
         if options.get('--uwsgi-config'):
             state.env.UWSGI_CONFIG_TEMPLATE = options.get('--uwsgi-config')
         if options.get('--python'):
             state.env.PYTHON_VERSION = options.get('--python')
-        execute(add_developer, project_slug=options['<project_slug>'],
-                               developer=options['<developer>'])
+        split = lambda value: [item.strip() for item in value.split(',') if item.strip()]
+        execute(add_developers, project_slugs=split(options['<project_slug>']),
+                                developers=split(options['<developer>']))
 
 
 def boilerplate(options):
@@ -292,5 +415,7 @@ def boilerplate(options):
        Usage:
           fct boilerplate <project_slug>
     """
+    from fabric.tasks import execute
+    from fc_toolbelt.tasks.project import open_tin
     if options['boilerplate']:
         execute(open_tin, project_slug=options['<project_slug>'])
@@ -0,0 +1,97 @@
+# coding: utf-8
+from functools import partial
+import threading
+import time
+import urlparse
+
+from fabric.state import env
+import requests
+from requests.adapters import HTTPAdapter
+
+
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """ Keep-alive session with default timeout and retries
+
+        Idempotent requests are retried with exponential backoff
+        on connection errors, timeouts and 5xx responses.
+
+        Settings: HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, HTTP_POOL_SIZE
+    """
+
+    def __init__(self):
+        super(PooledSession, self).__init__()
+        self.timeout = float(env.get('HTTP_TIMEOUT', 30))
+        self.retries = int(env.get('HTTP_RETRIES', 3))
+        self.backoff = float(env.get('HTTP_BACKOFF', 0.5))
+        pool_size = int(env.get('HTTP_POOL_SIZE', 16))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            try:
+                response = super(PooledSession, self).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+
+
+def get_session(url):
+    """ Shared session for host of url, so connections are reused between tasks"""
+    parsed_url = urlparse.urlparse(url)
+    key = (parsed_url.scheme, parsed_url.netloc)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = PooledSession()
+        return _sessions[key]
+
+
+class Api(object):
+    """ Chainable REST resource on top of shared session
+
+        api = Api('http://gitlab.com', params={'private_token': token})('api', 'v3')
+        api.projects(project_slug).members.POST(data={...})
+    """
+    HTTP_METHODS = ('GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+    def __init__(self, url, headers=None, params=None, auth=None):
+        self._url = url.rstrip('/')
+        self._session = get_session(url)
+        self._headers = headers or {}
+        self._params = params or {}
+        self._auth = auth
+
+    def __call__(self, *parts):
+        child = Api.__new__(Api)
+        child.__dict__.update(self.__dict__)
+        child._url = '/'.join([self._url] + [str(part).strip('/') for part in parts])
+        return child
+
+    def __getattr__(self, name):
+        if name in self.HTTP_METHODS:
+            return partial(self._request, name)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self(name)
+
+    def _request(self, method, *parts, **kwargs):
+        url = self(*parts)._url if parts else self._url
+        kwargs['headers'] = dict(self._headers, **kwargs.get('headers') or {})
+        kwargs['params'] = dict(self._params, **kwargs.get('params') or {})
+        kwargs.setdefault('auth', self._auth)
+        return self._session.request(method, url, **kwargs)
@@ -1,4 +1,13 @@
 # coding: utf-8
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from fabric.colors import green, yellow
 from fabric.context_managers import settings, hide
 from fabric.tasks import Task
 from fabric.api import local
@@ -8,15 +17,74 @@ from fabric.utils import puts
 __all__ = ['update']
 
 
+class UpdateState(object):
+    """ Requirements hashes, step timings and HEAD each step last succeeded at
+
+        Stored in repo's git dir, nothing is stored if it's not a git repo.
+    """
+    FILENAME = 'fc_toolbelt_update.json'
+
+    def __init__(self, git_dir):
+        self.path = os.path.join(git_dir, self.FILENAME) if git_dir else None
+        self.requirements = {}
+        self.timings = {}
+        self.heads = {}
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as state_file:
+                data = json.load(state_file)
+            self.requirements, self.timings = data['requirements'], data['timings']
+            self.heads = data.get('heads', {})
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump({'requirements': self.requirements, 'timings': self.timings, 'heads': self.heads},
+                      state_file)
+        os.rename(tmp_path, self.path)
+
+
 class BaseUpdateLocalEnvTask(Task):
-    """Update local project environment """
+    """Update local project environment
+
+       Steps are skipped when changes since their last successful run
+       don't need them, unless update is forced.
+    """
     name = 'update'
+    REQUIREMENTS_FILES = ('requirements*.txt', 'requirements/*.txt')
+
+    def git(self, command):
+        """ Output of git command, None if it failed (e.g. not a git repo)"""
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
+            result = local('git %s' % command, capture=True)
+        return result.strip() if result.succeeded else None
 
     def update_code(self):
+        """ Pull and return new HEAD, None if it's unknown"""
         puts('Updating code...')
         # In case it's not a git repo, skip
         with settings(hide('warnings'), warn_only=True):
             local('git pull')
+        return self.git('rev-parse HEAD')
+
+    def changed_since(self, step, head):
+        """ Paths changed since step last succeeded, None if they are unknown"""
+        last = self.state.heads.get(step)
+        if head is None or last is None:
+            return None
+        if last == head:
+            return []
+        changed = self.git('diff --name-only %s %s' % (last, head))
+        return None if changed is None else changed.splitlines()
+
+    def get_requirements_hashes(self):
+        hashes = {}
+        for pattern in self.REQUIREMENTS_FILES:
+            for path in glob.glob(pattern):
+                with open(path, 'rb') as requirements_file:
+                    hashes[path] = hashlib.sha1(requirements_file.read()).hexdigest()
+        return hashes
 
     def virtualenv_update(self):
         """Update packages first"""
@@ -30,8 +98,37 @@ class BaseUpdateLocalEnvTask(Task):
         puts('Reloading application...')
         local('touch ../reload.txt')
 
+    def run_step(self, name, func, needed, head=None):
+        """ Run and time step if it's needed, True if it was run
+
+            HEAD is remembered for the step once it's done or not needed,
+            so changes stay pending for the step until it succeeds.
+        """
+        ran = bool(needed or self.force)
+        if ran:
+            started = time.time()
+            func()
+            self.state.timings[name] = time.time() - started
+        else:
+            self.skipped.append(name)
+        if head is not None:
+            self.state.heads[name] = head
+        self.state.save()
+        return ran
+
+    def report_skipped(self):
+        if not self.skipped:
+            return
+        message = 'Skipped: %s' % ', '.join(self.skipped)
+        timings = [self.state.timings[name] for name in self.skipped if name in self.state.timings]
+        if timings:
+            message += ', saved ~%.1fs' % sum(timings)
+        puts(yellow(message + ' (use --force to run everything)'))
+
 
 class DjangoUpdateLocalEnv(BaseUpdateLocalEnvTask):
+    MIGRATIONS_PATTERN = re.compile(r'(^|/)(models\.py$|models/|migrations/)')
+    MIGRATE_RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrate_runner.py')
 
     def smart_syncdb_migrate(self):
         """Workaround manage.py migrate complications
@@ -39,17 +136,55 @@ class DjangoUpdateLocalEnv(BaseUpdateLocalEnvTask):
              so we make sure south_migrationhistory table is created
            * run migrate to apply latest migrations
            * run syncdb again to populate contrib.auth.models
+
+           All three run in one interpreter (see migrate_runner.py),
+           so project is imported once.
         """
-        local('python manage.py syncdb')
-        local('python manage.py migrate')
-        local('python manage.py syncdb --all')
+        puts('Syncing database...')
+        fd, result_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            local('python %s %s' % (self.MIGRATE_RUNNER, result_path))
+            with open(result_path) as result_file:
+                result = json.load(result_file)
+        finally:
+            os.remove(result_path)
 
-    def run(self, *args, **kwargs):
+        for phase in result['phases']:
+            puts('%-14s %6.1fs' % (phase['name'], phase['seconds']))
+        if result['applied']:
+            puts(green('Applied migrations: %s' % ', '.join(result['applied'])))
+        else:
+            puts('No new migrations')
+        return result
+
+    def run(self, force=False, *args, **kwargs):
+        """ Packages are installed if requirements files changed since last update,
+            database is synced if commits since its last sync touched models
+            or migrations (or packages were installed), application is reloaded
+            if anything changed since last reload.
+        """
         puts('Update process started...')
-        self.update_code()
-        self.virtualenv_update()
-        self.smart_syncdb_migrate()
-        self.reload()
+        self.force = force
+        self.skipped = []
+        self.state = UpdateState(self.git('rev-parse --git-dir'))
+
+        head = self.update_code()
+        requirements = self.get_requirements_hashes()
+        installed = self.run_step('packages', self.virtualenv_update, requirements != self.state.requirements)
+        self.state.requirements = requirements
+        if installed:
+            # new packages may bring migrations, sync and reload until they succeed
+            self.state.heads.pop('database', None)
+            self.state.heads.pop('reload', None)
+        self.state.save()
+
+        changed = self.changed_since('database', head)
+        self.run_step('database', self.smart_syncdb_migrate,
+                      changed is None or any(self.MIGRATIONS_PATTERN.search(path) for path in changed), head)
+        changed = self.changed_since('reload', head)
+        self.run_step('reload', self.reload, changed is None or bool(changed), head)
+        self.report_skipped()
 
 
 update = DjangoUpdateLocalEnv()
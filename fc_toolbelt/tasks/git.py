@@ -1,49 +1,233 @@
 # coding: utf-8
-from fabric.api import local, run
+import json
+import os
+import re
+import subprocess
+import tempfile
+
+from fabric.colors import green, red, yellow
+from fabric.contrib.console import confirm
+from fabric.state import env
 from fabric.tasks import Task
+from fabric.utils import abort, puts
 
 
 __all__ = ['prune']
 
 
 class DeleteMergedBranches(Task):
-    """Useful git aliases"""
+    """Delete remote branches merged into base branch
+
+       Merged branches of a remote are listed by one for-each-ref and deleted
+       by atomic pushes of CHUNK_SIZE branches, remotes are pushed to in parallel.
+       Every delete is leased to the listed commit, so a branch that got
+       new commits in the meantime is kept.
+
+       Protected branches are never deleted, they are read from
+       git config fct.protected (comma-separated), default_branches otherwise.
+    """
     name = 'git'
     default_branches = ('dev', 'master')
+    CHUNK_SIZE = 50
+
+    def get_protected(self):
+        process = subprocess.Popen(['git', 'config', '--get', 'fct.protected'], stdout=subprocess.PIPE)
+        protected = process.communicate()[0].strip()
+        return protected.split(',') if protected else self.default_branches
+
+    def get_merged_branches(self, remote, base, protected):
+        """ (branch, sha) of remote branches merged into remote's base"""
+        prefix = 'refs/remotes/%s/' % remote
+        branches = []
+        for line in iter_git_lines('for-each-ref', '--merged=%s%s' % (prefix, base),
+                                   '--format=%(refname) %(objectname)', prefix):
+            ref, sha = line.split()
+            branch = ref[len(prefix):]
+            if branch != 'HEAD' and branch not in protected:
+                branches.append((branch, sha))
+        return branches
+
+    def delete_branches(self, remote, branches):
+        """ Push deletes in chunks, return number of deleted branches"""
+        deleted = 0
+        for start in range(0, len(branches), self.CHUNK_SIZE):
+            chunk = branches[start:start + self.CHUNK_SIZE]
+            args = ['git', 'push', '--atomic', '--quiet']
+            args += ['--force-with-lease=refs/heads/%s:%s' % branch for branch in chunk]
+            args += [remote] + [':refs/heads/%s' % branch for branch, sha in chunk]
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            if process.returncode:
+                puts(red('Failed to delete %s branch(es) from %s:\n%s' % (len(chunk), remote, output.strip())))
+            else:
+                deleted += len(chunk)
+                puts('Deleted %s branch(es) from %s' % (len(chunk), remote))
+        return deleted
+
+    def run(self, remotes=('origin',), base='master', protected=None, dry_run=False, force=False):
+        from fc_toolbelt.tasks.utils import parallel_map  # thread pool is only needed to delete
 
-    delete_merged_brances_cmd = ('echo git push origin'
-                                 '$(git branch -r --merged origin/master'
-                                 '| sed "s/origin\\//:/" | egrep -v "HEAD|%s")' % '|'.join(default_branches))
+        protected = set(protected or self.get_protected()) | set([base])
+        merged = dict((remote, self.get_merged_branches(remote, base, protected)) for remote in remotes)
+        total = sum(len(branches) for branches in merged.values())
+        if not total:
+            puts("No old branches, yeah!")
+            return
 
-    def run(self):
-        result = local(self.delete_merged_brances_cmd, capture=True)
-        if result == 'git push origin':
-            print "No old branches, yeah!"
-        else:
-            print result
+        for remote in remotes:
+            for branch, sha in merged[remote]:
+                puts('%s/%s' % (remote, branch))
+        if dry_run:
+            puts('%s merged branch(es) would be deleted' % total)
+            return
+        if not force and not confirm('Delete %s merged branch(es)?' % total, default=False):
+            abort('Cancelled')
+
+        remotes = [remote for remote in remotes if merged[remote]]
+        deleted = sum(parallel_map(lambda remote: self.delete_branches(remote, merged[remote]),
+                                   remotes, len(remotes)))
+        puts(green('Deleted %s of %s merged branch(es)' % (deleted, total)))
+        if deleted < total:
+            abort(red('%s branch(es) were not deleted' % (total - deleted)))
 
 
 class GetBranch(Task):
-    """Get branch by mask"""
+    """Get branch by mask
+
+       All refs are read once per process and kept sorted by committer date,
+       masks are regexps matched against that table, most recent ref wins.
+    """
 
     name = 'get_git_branch'
-    get_branch_commnad = (
-        """git for-each-ref --sort='-committerdate' --format='%(refname:short)' """
-        """| grep '{0}' | head -n 1"""
-    )
+    refs = None
 
-    def run(self, git_branch, **kwargs):
-        result = local(self.get_branch_commnad.format(git_branch), capture=True)
+    def get_refs(self):
+        if GetBranch.refs is None:
+            GetBranch.refs = list(iter_git_lines('for-each-ref', '--sort=-committerdate',
+                                                 '--format=%(refname:short)'))
+        return GetBranch.refs
 
-        branch_name = result.strip()
+    def resolve(self, *masks):
+        return [self.run(mask) for mask in masks]
 
-        if not branch_name:
+    def run(self, git_branch, **kwargs):
+        mask = re.compile(git_branch)
+        matches = [ref for ref in self.get_refs() if mask.search(ref)]
+
+        if not matches:
             raise AttributeError(
                 "Bad git branch mask: \n"
-                "%s" % result
+                "%s" % git_branch
             )
+        if len(matches) > 1:
+            puts(yellow('Mask %r is ambiguous, using most recent %s of: %s%s' % (
+                git_branch, matches[0], ', '.join(matches[1:6]), ', ...' if len(matches) > 6 else '')))
+
+        return matches[0]
+
+
+def iter_git_lines(*args, **kwargs):
+    """ Stream output of git command line by line, without buffering it all"""
+    process = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE, stdin=kwargs.get('stdin'))
+    for line in iter(process.stdout.readline, ''):
+        yield line.rstrip('\n')
+    process.stdout.close()
+    if process.wait():
+        abort(red('git %s failed with code %s' % (' '.join(args), process.returncode)))
+
+
+class TicketExtractor(object):
+    """ Finds Redmine ticket ids in commit messages
+
+        Patterns are names of PATTERNS or custom regexps, first group of
+        a regexp has to contain ticket references (#N, maybe several).
+        Configured with comma-separated TICKET_PATTERNS setting.
+    """
+    TICKET_LIST = r'(#\d+(?:(?:\s*,\s*|\s*&\s*|\s+and\s+)#\d+)*)'
+    PATTERNS = {
+        'bare': r'(#\d+)',
+        'refs': r'\b(?:refs|references|issueid)\s+' + TICKET_LIST,
+        'fixes': r'\b(?:fix|fixes|fixed|closes|closed)\s+' + TICKET_LIST,
+    }
+
+    def __init__(self, patterns=None):
+        patterns = patterns or env.get('TICKET_PATTERNS', 'bare')
+        if isinstance(patterns, basestring):
+            patterns = [pattern.strip() for pattern in patterns.split(',') if pattern.strip()]
+        self.regexps = [re.compile(self.PATTERNS.get(pattern, pattern), re.IGNORECASE)
+                        for pattern in patterns]
+
+    def ticket_ids(self, message):
+        ids = set()
+        for regexp in self.regexps:
+            for references in regexp.findall(message):
+                if isinstance(references, tuple):
+                    references = references[0]
+                ids.update(re.findall(r'#(\d+)', references))
+        return ids
+
+    def git_ticket_ids(self, from_ref, to_ref):
+        """ Ticket ids mentioned in commits from_ref has and to_ref hasn't"""
+        ids = set()
+        for subject in iter_git_lines('log', from_ref, '--not', to_ref, '--format=%s', '--no-merges'):
+            ids.update(self.ticket_ids(subject))
+        return ids
+
+
+class CommitTicketIndex(object):
+    """ Persistent map of commit sha to ticket ids, one per repo
+
+        Stored in repo's git dir. Only commits that are not indexed yet
+        have their messages parsed, so diffing same refs over and over
+        is just a rev-list and a set lookup. Entries of commits that are
+        no longer reachable from any ref (e.g. after force-push) are dropped.
+    """
+    FILENAME = 'fc_toolbelt_tickets.json'
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        git_dir = subprocess.check_output(['git', 'rev-parse', '--git-dir']).strip()
+        self.path = os.path.join(git_dir, self.FILENAME)
+        self.patterns = [regexp.pattern for regexp in extractor.regexps]
+        self.commits = {}
+        if os.path.exists(self.path):
+            with open(self.path) as index_file:
+                data = json.load(index_file)
+            if data['patterns'] == self.patterns:
+                self.commits = data['commits']
+
+    def git_ticket_ids(self, from_ref, to_ref):
+        """ Ticket ids mentioned in commits from_ref has and to_ref hasn't"""
+        shas = set(iter_git_lines('rev-list', from_ref, '--not', to_ref, '--no-merges'))
+        new_shas = [sha for sha in shas if sha not in self.commits]
+        if new_shas:
+            self.index_commits(new_shas)
+            self.drop_unreachable()
+            self.save()
+        ids = set()
+        for sha in shas:
+            ids.update(self.commits[sha])
+        return ids
+
+    def index_commits(self, shas):
+        # shas go through a file, so git's stdin and stdout can't block each other
+        with tempfile.TemporaryFile() as shas_file:
+            shas_file.write('\n'.join(shas))
+            shas_file.seek(0)
+            for line in iter_git_lines('log', '--no-walk=unsorted', '--stdin', '--format=%H %s', stdin=shas_file):
+                sha, _, subject = line.partition(' ')
+                self.commits[sha] = sorted(self.extractor.ticket_ids(subject))
+
+    def drop_unreachable(self):
+        reachable = set(iter_git_lines('rev-list', '--all', '--no-merges'))
+        for sha in [sha for sha in self.commits if sha not in reachable]:
+            del self.commits[sha]
 
-        return branch_name
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'patterns': self.patterns, 'commits': self.commits}, index_file)
+        os.rename(tmp_path, self.path)
 
 
 get_branch = GetBranch()
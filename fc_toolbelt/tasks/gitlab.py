@@ -1,13 +1,72 @@
 # coding: utf-8
+import hashlib
 import urlparse
 
 from fabric.api import env
-from fabric.colors import red, yellow
+from fabric.colors import green, red, yellow
 from fabric.tasks import Task
 from fabric.utils import abort, puts
-from hammock import Hammock
 import requests
 
+from fc_toolbelt.tasks.api import Api
+from fc_toolbelt.tasks.utils import CachedDirectory, get_cache_path, parallel_map, report_results
+
+
+class GitlabDirectory(CachedDirectory):
+    """ Users and projects of Gitlab instance, indexed by email, path and id
+
+        All pages are fetched concurrently (GITLAB_CONCURRENCY), result is cached
+        on disk for GITLAB_DIRECTORY_TTL seconds.
+    """
+    PER_PAGE = 100
+
+    def __init__(self, api, gitlab_url, ttl=None):
+        self.api = api
+        self.concurrency = int(env.get('GITLAB_CONCURRENCY', 8))
+        cache_key = hashlib.sha1('%s %s' % (gitlab_url, env.get('GITLAB_TOKEN', ''))).hexdigest()
+        super(GitlabDirectory, self).__init__(get_cache_path('gitlab', '%s.json' % cache_key),
+                                              float(ttl or env.get('GITLAB_DIRECTORY_TTL', 300)))
+
+    def fetch(self):
+        return {'users': self.get_all_pages('users'), 'projects': self.get_all_pages('projects')}
+
+    def get_all_pages(self, resource):
+        """ Pages after first are requested in waves of concurrent requests
+            until a short page, unless Gitlab tells X-Total-Pages.
+        """
+        def get_page(page):
+            return self.api(resource).GET(params={'page': page, 'per_page': self.PER_PAGE})
+
+        first_page = get_page(1)
+        pages = [first_page.json()]
+        total_pages = first_page.headers.get('X-Total-Pages')
+        if total_pages:
+            pages += [response.json() for response in
+                      parallel_map(get_page, range(2, int(total_pages) + 1), self.concurrency)]
+        else:
+            next_page = 2
+            while len(pages[-1]) == self.PER_PAGE:
+                wave = range(next_page, next_page + self.concurrency)
+                pages += [response.json() for response in parallel_map(get_page, wave, self.concurrency)]
+                next_page += self.concurrency
+        return [obj for page in pages for obj in page]
+
+    def build_indexes(self, data):
+        self.users = data['users']
+        self.projects = data['projects']
+        self.users_by_email = dict((user['email'].lower(), user) for user in self.users)
+        self.projects_by_path = {}
+        for project in self.projects:
+            for key in ('id', 'code', 'path', 'path_with_namespace'):
+                if project.get(key) is not None:
+                    self.projects_by_path[unicode(project[key])] = project
+
+    def get_user(self, email):
+        return self.lookup(lambda: self.users_by_email.get(email.lower()))
+
+    def get_project(self, path_or_id):
+        return self.lookup(lambda: self.projects_by_path.get(unicode(path_or_id)))
+
 
 class BaseGitlabTask(Task):
     """ Base for all Gitlab tasks
@@ -21,14 +80,24 @@ class BaseGitlabTask(Task):
         Exmaple: export GITLAB_URL=http://gilabhq.com/
                  export GITLAB_TOKEN=2334859fa3458903
     """
+    directory = None
+
+    def get_directory(self):
+        if self.directory is None:
+            self.directory = GitlabDirectory(self.api, self.GITLAB_URL)
+        return self.directory
+
     def project_exists(self, project_slug):
-        return project_slug in [project['code'] for project in self.api.projects.GET().json]
+        return self.get_directory().get_project(project_slug) is not None
 
     def get_user_by_email(self, email):
-        return filter(lambda user: user['email'] == email, self.api.users.GET().json)[0]
+        user = self.get_directory().get_user(email)
+        if user is None:
+            raise IndexError(email)
+        return user
 
     def get_users_emails(self):
-        return [user['email'] for user in self.api.users.GET().json if not user['blocked']]
+        return [user['email'] for user in self.get_directory().users if not user.get('blocked')]
 
     def get_repo_url_by_path(self, path):
         return "git@%(host)s:%(path)s.git" % {'host': self.GITLAB_HOST,
@@ -45,7 +114,7 @@ class BaseGitlabTask(Task):
         if not GITLAB_TOKEN:
             abort(red('Go to %s/profile/account and grab yourself a token' % self.GITLAB_URL))
 
-        self.api = Hammock(self.GITLAB_URL, params={'private_token': env.GITLAB_TOKEN}).api('v3')
+        self.api = Api(self.GITLAB_URL, params={'private_token': env.GITLAB_TOKEN}).api('v3')
         return self
 
 
@@ -83,26 +152,49 @@ class AssignDeveloper(BaseGitlabTask):
     REPORTER = 20
     GUEST = 10
 
-    def run(self, project_slug, user_email, access_level=DEVELOPER):
-        puts('Creating project "%r"...' % project_slug)
-        super(AssignDeveloper, self).connect()
-        if not (self.project_exists(project_slug)):
-            abort(red("Project %s does not exist or you don't have right to manipulate its members" % project_slug))
+    ADDED = 'added'
+    PRESENT = 'already present'
+    FAILED = 'failed'
+
+    def run(self, project_slug=None, user_email=None, access_level=DEVELOPER, assignments=None):
+        """ Assign user_email to project_slug or every (project_slug, user_email) of assignments.
 
-        try:
-            user = self.get_user_by_email(user_email)
-        except IndexError:
-            abort(red('No user with email %s registered at Gitlab' % user_email))
-            return
+            Projects and users are resolved from one directory fetch,
+            memberships are posted concurrently (GITLAB_CONCURRENCY).
+        """
+        assignments = assignments or [(project_slug, user_email)]
+        puts('Assigning %s membership(s)...' % len(assignments))
+        super(AssignDeveloper, self).connect()
 
+        results, memberships = [], []
+        for project_slug, user_email in assignments:
+            if not self.project_exists(project_slug):
+                results.append((self.FAILED, "Project %s does not exist or you don't have right "
+                                             "to manipulate its members" % project_slug))
+                continue
+            try:
+                user = self.get_user_by_email(user_email)
+            except IndexError:
+                results.append((self.FAILED, 'No user with email %s registered at Gitlab' % user_email))
+                continue
+            memberships.append((project_slug, user, access_level))
+
+        results += parallel_map(self.add_member, memberships, self.get_directory().concurrency)
+
+        report_results(results, [(self.ADDED, green), (self.PRESENT, yellow), (self.FAILED, red)],
+                       failed=self.FAILED, noun='membership')
+
+    def add_member(self, membership):
+        project_slug, user, access_level = membership
         response = self.api.projects(project_slug).members.POST(data={
             'id': project_slug,
             'user_id': user['id'],
             'access_level': access_level})
 
-        if response.status_code != requests.codes.created:
-            puts(yellow('User %s not added %s (might be already added)' % (user_email, response.content)))
-        else:
-            puts("Assigned %s to project %s" % (user['name'], project_slug))
+        if response.status_code == requests.codes.created:
+            return self.ADDED, "Assigned %s to project %s" % (user['name'], project_slug)
+        elif response.status_code == requests.codes.conflict:
+            return self.PRESENT, 'User %s is already a member of %s' % (user['email'], project_slug)
+        return self.FAILED, 'User %s not added to %s: %s' % (user['email'], project_slug, response.content)
 
 assign = AssignDeveloper()
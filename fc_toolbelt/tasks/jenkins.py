@@ -1,9 +1,15 @@
 # coding: utf-8
-from fabric.colors import red
+import re
+import time
+
+from fabric.colors import green, red, yellow
 from fabric.state import env
 from fabric.tasks import Task
 from fabric.utils import abort, puts
-from jenkinsapi import jenkins
+import requests
+
+from fc_toolbelt.tasks.api import Api
+from fc_toolbelt.tasks.utils import parallel_map, report_results
 
 
 class BaseJenkinsTask(Task):
@@ -26,25 +32,153 @@ class BaseJenkinsTask(Task):
         if not all([JENKINS_LOGIN, JENKINS_PASSWORD]):
             abort(red('Provide both JENKINS_LOGIN and JENKINS_PASSWORD to connect to api'))
 
-        self.api = jenkins.Jenkins(self.JENKINS_URL, JENKINS_LOGIN, JENKINS_PASSWORD)
+        auth = (JENKINS_LOGIN, JENKINS_PASSWORD)
+        self.api = Api(self.JENKINS_URL, headers=self.get_crumb_headers(auth), auth=auth)
+        self.concurrency = int(env.get('JENKINS_CONCURRENCY', 4))
+
+    def get_crumb_headers(self, auth):
+        """ CSRF protection header for POST requests, if Jenkins has it enabled"""
+        response = Api(self.JENKINS_URL, auth=auth).crumbIssuer.api.json.GET()
+        if response.status_code != requests.codes.ok:
+            return {}
+        crumb = response.json()
+        return {crumb['crumbRequestField']: crumb['crumb']}
 
 
 class CreateJob(BaseJenkinsTask):
-    """ Create new job in Jenkins from template job """
+    """ Create new jobs in Jenkins from template jobs
+
+        Config of every template job is downloaded once and rendered
+        locally for every job, then jobs are created with their final
+        config by one request each and built, concurrently (JENKINS_CONCURRENCY).
+    """
     name = 'create_job'
 
-    def run(self, job_name, project_slug, template_job=None):
+    CREATED = 'created'
+    PRESENT = 'already present'
+    FAILED = 'failed'
+    SUCCESS = 'SUCCESS'
+    POLL_MIN_DELAY = 1
+    POLL_MAX_DELAY = 30
+
+    def run(self, job_name=None, project_slug=None, template_job=None, jobs=None, wait=False):
+        """ Create job_name for project_slug or every (project_slug, job_name, template_job) of jobs.
+
+            With wait, follow triggered builds and abort unless all of them succeeded.
+        """
         super(CreateJob, self).run()
-        template_job = template_job or env.get('JENKINS_TEMPLATE_JOB', 'example-tests')
-        job = self.api.copy_job(template_job, job_name)
-        job.enable()
-        self.setup_job_config(job, context={'project': project_slug})
-        job.invoke()
-        puts("Created job %s/job/%s/" % (self.JENKINS_URL, job_name))
-
-    def setup_job_config(self, job, context):
-        config = job.get_config()
+        self.queue_urls = {}
+        default_template = env.get('JENKINS_TEMPLATE_JOB', 'example-tests')
+        jobs = [(project, job, template or default_template)
+                for project, job, template in jobs or [(project_slug, job_name, template_job)]]
+        puts('Creating %s job(s)...' % len(jobs))
+
+        templates = sorted(set(template for project, job, template in jobs))
+        configs = dict(zip(templates, parallel_map(self.get_config, templates, self.concurrency)))
+
+        results, new_jobs = [], []
+        for project, job, template in jobs:
+            if configs[template] is None:
+                results.append((self.FAILED, 'Template job %s not found for %s' % (template, job)))
+                continue
+            new_jobs.append((job, self.setup_job_config(configs[template], context={'project': project})))
+
+        results += parallel_map(self.create_job, new_jobs, self.concurrency)
+
+        report_results(results, [(self.CREATED, green), (self.PRESENT, yellow), (self.FAILED, red)],
+                       failed=self.FAILED, noun='job')
+        if wait:
+            self.wait_for_builds(sorted(self.queue_urls.items()))
+
+    def get_config(self, job_name):
+        response = self.api.job(job_name)('config.xml').GET()
+        return response.content if response.status_code == requests.codes.ok else None
+
+    def setup_job_config(self, config, context):
+        """ Render template job config and enable job"""
         config = config.format(**context)
-        job.update_config(config)
+        return config.replace('<disabled>true</disabled>', '<disabled>false</disabled>')
+
+    def create_job(self, job):
+        job_name, config = job
+        response = self.api.createItem.POST(params={'name': job_name}, data=config,
+                                            headers={'Content-Type': 'application/xml'})
+        if response.status_code == requests.codes.bad_request and \
+                'already exists' in response.headers.get('X-Error', ''):
+            return self.PRESENT, 'Job %s already exists' % job_name
+        if response.status_code != requests.codes.ok:
+            return self.FAILED, 'Job %s not created: %s' % (
+                job_name, response.headers.get('X-Error') or response.status_code)
+
+        response = self.api.job(job_name).build.POST()
+        if response.status_code not in (requests.codes.ok, requests.codes.created):
+            return self.FAILED, 'Job %s created, but not started: %s' % (job_name, response.status_code)
+        self.queue_urls[job_name] = response.headers.get('Location')
+        return self.CREATED, 'Created job %s/job/%s/' % (self.JENKINS_URL, job_name)
+
+    def wait_for_builds(self, queue_urls):
+        self.prefix_logs = len(queue_urls) > 1
+        results = parallel_map(self.wait_for_build, queue_urls, len(queue_urls))
+        for (job_name, queue_url), result in zip(queue_urls, results):
+            puts((green if result == self.SUCCESS else red)('Build of %s: %s' % (job_name, result)))
+        failed = len([result for result in results if result != self.SUCCESS])
+        if failed:
+            abort(red('%s build(s) did not succeed' % failed))
+
+    def get_delays(self):
+        delay = self.POLL_MIN_DELAY
+        while True:
+            yield delay
+            delay = min(delay * 2, self.POLL_MAX_DELAY)
+
+    def wait_for_build(self, job):
+        """ Wait for queued build to start, stream its log and return its result"""
+        job_name, queue_url = job
+        match = re.search(r'/queue/item/(\d+)', queue_url or '')
+        if not match:
+            return 'NOT FOUND IN QUEUE'
+
+        delays = self.get_delays()
+        while True:
+            response = self.api.queue.item(match.group(1)).api.json.GET()
+            if response.status_code != requests.codes.ok:
+                return 'NOT FOUND IN QUEUE'
+            item = response.json()
+            if item.get('cancelled'):
+                return 'CANCELLED'
+            if item.get('executable'):
+                break
+            time.sleep(next(delays))
+
+        build = self.api.job(job_name)(item['executable']['number'])
+        puts('Build #%s of %s started' % (item['executable']['number'], job_name))
+        self.stream_log(job_name, build)
+
+        delays = self.get_delays()
+        while True:
+            state = build.api.json.GET(params={'tree': 'building,result'}).json()
+            if not state.get('building') and state.get('result'):
+                return state['result']
+            time.sleep(next(delays))
+
+    def stream_log(self, job_name, build):
+        """ Print console log as it grows, only new text is requested every time"""
+        prefix = '%s | ' % job_name if self.prefix_logs else ''
+        start, partial_line = 0, ''
+        delays = self.get_delays()
+        while True:
+            response = build.logText.progressiveText.GET(params={'start': start})
+            start = int(response.headers.get('X-Text-Size', start))
+            if response.text:
+                lines = (partial_line + response.text).split('\n')
+                partial_line = lines.pop()
+                for line in lines:
+                    puts(prefix + line, show_prefix=False)
+                delays = self.get_delays()
+            if response.headers.get('X-More-Data') != 'true':
+                break
+            time.sleep(next(delays))
+        if partial_line:
+            puts(prefix + partial_line, show_prefix=False)
 
 create_job = CreateJob()
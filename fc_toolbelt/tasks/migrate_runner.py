@@ -0,0 +1,70 @@
+# coding: utf-8
+""" Runs syncdb, migrate and syncdb --all in a single interpreter
+
+    Started by fct update with project's python from project dir,
+    so Django, settings and apps are imported once instead of three times:
+
+        python migrate_runner.py <result.json>
+
+    Timings of phases and South migrations applied by them are written as JSON.
+
+    manage.py itself is not run: only project dir is put on sys.path and
+    settings module is read from it. If manage.py adds other dirs to
+    sys.path (e.g. apps/ or lib/), put them on PYTHONPATH for fct update.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+
+SETTINGS_PATTERN = re.compile(r'''DJANGO_SETTINGS_MODULE['"]\s*,\s*['"]([\w.]+)['"]''')
+PHASES = (
+    ('syncdb', 'syncdb', {}),                           # creates south_migrationhistory on first run
+    ('migrate', 'migrate', {}),                         # applies latest migrations
+    ('syncdb --all', 'syncdb', {'migrate_all': True}),  # populates contrib.auth.models
+)
+
+
+def get_settings_module():
+    """ Settings module from environment or manage.py"""
+    if os.environ.get('DJANGO_SETTINGS_MODULE'):
+        return os.environ['DJANGO_SETTINGS_MODULE']
+    with open('manage.py') as manage_file:
+        match = SETTINGS_PATTERN.search(manage_file.read())
+    return match.group(1) if match else 'settings'
+
+
+def get_applied_migrations():
+    try:
+        from south.models import MigrationHistory
+    except ImportError:
+        return set()
+    from django.db import connection
+    if MigrationHistory._meta.db_table not in connection.introspection.table_names():
+        return set()
+    return set('%s.%s' % pair for pair in MigrationHistory.objects.values_list('app_name', 'migration'))
+
+
+def main(result_path):
+    sys.path.insert(0, os.getcwd())
+    os.environ['DJANGO_SETTINGS_MODULE'] = get_settings_module()
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from django.core.management import call_command
+
+    before = get_applied_migrations()
+    phases = []
+    for name, command, options in PHASES:
+        started = time.time()
+        call_command(command, **options)
+        phases.append({'name': name, 'seconds': time.time() - started})
+
+    with open(result_path, 'w') as result_file:
+        json.dump({'phases': phases, 'applied': sorted(get_applied_migrations() - before)}, result_file)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -1,14 +1,61 @@
 # coding: utf-8
-from fabric.api import execute, run, settings, hide, puts
+from fabric.api import run, settings, hide, puts
+from fabric.colors import red
 from fabric.tasks import Task
+from fabric.utils import abort
+
+
+class MysqlSession(object):
+    """ Statements sent to mysql as one script, in a single round-trip
+
+        Every statement is followed by a marker select, mysql stops at
+        the first error, so markers in output tell which statements
+        succeeded and which one failed. Output of each statement
+        (e.g. existence checks) is passed to its report callback.
+    """
+    MARKER = 'fct-step'
+
+    def __init__(self, user='root'):
+        self.user = user
+        self.steps = []
+
+    def add(self, label, sql, report=None):
+        self.steps.append((label, sql, report))
+        return self
+
+    def get_script(self):
+        return '\n'.join("%s\nSELECT '%s %s';" % (sql.strip(), self.MARKER, index)
+                         for index, (label, sql, report) in enumerate(self.steps))
+
+    def run(self):
+        """ Run script, report every step, abort on failed one"""
+        with settings(hide('warnings', 'running', 'stdout'), warn_only=True):
+            result = run("mysql --user='%s' --batch --skip-column-names <<'FCT_SQL'\n%s\nFCT_SQL" % (
+                self.user, self.get_script()))
+
+        outputs, output = {}, []
+        for line in result.splitlines():
+            if line.startswith(self.MARKER):
+                outputs[int(line.split()[1])] = output
+                output = []
+            else:
+                output.append(line.strip())
+
+        for index, (label, sql, report) in enumerate(self.steps):
+            if index not in outputs:
+                abort(red('%s failed: %s' % (label, result.stderr or result)))
+            message = report(outputs[index]) if report else None
+            puts(message or '%s: ok' % label)
+        return [outputs[index] for index in range(len(self.steps))]
 
 
 class BaseMysqlTask(Task):
     """ Base for all Mysql tasks with helpers"""
 
-    def execute(self, sql, user):
-        sql = sql.replace('"', r'\"')
-        return run('echo "%s" | mysql --user="%s"' % (sql, user))
+    def run(self, *args, **kwargs):
+        session = MysqlSession('root')
+        self.add_statements(session, *args, **kwargs)
+        return session.run()
 
 
 class CreateDevDb(Task):
@@ -16,49 +63,38 @@ class CreateDevDb(Task):
     name = 'create_dev_db'
 
     def run(self, project, user, password=''):
-        execute(CreateUser(), project, password)
         db_name = '%s_%s' % (project, user)
-        execute(CreateDb(), db_name)
-        execute(GrantPermissions(), db_name, project)
+        session = MysqlSession('root')
+        CreateUser().add_statements(session, project, password)
+        CreateDb().add_statements(session, db_name)
+        GrantPermissions().add_statements(session, db_name, project)
+        session.run()
 
 create_dev_db = CreateDevDb()
 
 
 class CreateUser(BaseMysqlTask):
     name = 'create_user'
-    MYSQL_USER_EXISTS = "SHOW GRANTS FOR '%s'@localhost;"
-    MYSQL_CREATE_USER = "CREATE USER '%s'@'localhost' IDENTIFIED BY '%s';"
+    MYSQL_USER_EXISTS = "SELECT COUNT(*) FROM mysql.user WHERE User = '%s' AND Host = 'localhost';"
+    MYSQL_CREATE_USER = "CREATE USER IF NOT EXISTS '%s'@'localhost' IDENTIFIED BY '%s';"
 
-    def run(self, user, password):
-        if self.user_exists(user):
-            puts('User %s already exists' % user)
-            return
-        self.execute(self.MYSQL_CREATE_USER % (user, password), 'root')
-
-    def user_exists(self, user):
-        sql = self.MYSQL_USER_EXISTS % user
-        with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
-            result = self.execute(sql, 'root')
-        return result.succeeded
+    def add_statements(self, session, user, password):
+        session.add('Check user %s' % user, self.MYSQL_USER_EXISTS % user,
+                    report=lambda output: 'User %s already exists' % user if output == ['1'] else None)
+        session.add('Create user %s' % user, self.MYSQL_CREATE_USER % (user, password))
 
 
 class CreateDb(BaseMysqlTask):
     name = 'create_db'
-    MYSQL_BASE_EXISTS = "USE %s;"
-    MYSQL_CREATE_DB = """CREATE DATABASE %s
+    MYSQL_BASE_EXISTS = "SELECT COUNT(*) FROM information_schema.schemata WHERE schema_name = '%s';"
+    MYSQL_CREATE_DB = """CREATE DATABASE IF NOT EXISTS %s
                                 DEFAULT CHARACTER SET utf8
                                 DEFAULT COLLATE utf8_general_ci;"""
 
-    def run(self, name):
-        if self.db_exists(name):
-            puts('Database %s already exists' % name)
-            return
-        self.execute(self.MYSQL_CREATE_DB % name, 'root')
-
-    def db_exists(self, name):
-        with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
-            result = self.execute(self.MYSQL_BASE_EXISTS % name, 'root')
-        return result.succeeded
+    def add_statements(self, session, name):
+        session.add('Check database %s' % name, self.MYSQL_BASE_EXISTS % name,
+                    report=lambda output: 'Database %s already exists' % name if output == ['1'] else None)
+        session.add('Create database %s' % name, self.MYSQL_CREATE_DB % name)
 
 
 class GrantPermissions(BaseMysqlTask):
@@ -66,5 +102,5 @@ class GrantPermissions(BaseMysqlTask):
     MYSQL_GRANT_PERMISSIONS = """GRANT ALL ON %s.* TO '%s'@'localhost';
                                  FLUSH PRIVILEGES;"""
 
-    def run(self, name, user):
-        self.execute(self.MYSQL_GRANT_PERMISSIONS % (name, user), 'root')
+    def add_statements(self, session, name, user):
+        session.add('Grant %s permissions on %s' % (user, name), self.MYSQL_GRANT_PERMISSIONS % (name, user))
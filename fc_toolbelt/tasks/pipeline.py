@@ -0,0 +1,140 @@
+# coding: utf-8
+from multiprocessing import Process, Queue
+from Queue import Empty
+import time
+
+from fabric.colors import green, red, yellow
+from fabric.state import connections
+from fabric.utils import abort, puts
+
+
+class Stage(object):
+    """ Named step of pipeline, runs after all stages it requires are done
+
+        Stage runs in a forked process, like tasks of fabric's parallel mode,
+        because fabric env and output settings are process-global.
+        in_process stages (interactive ones, or ones collecting state
+        for the caller) run in the main process, one at a time.
+    """
+
+    def __init__(self, name, func, requires=(), in_process=False):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.in_process = in_process
+
+
+class Pipeline(object):
+    """ Runs a DAG of stages, independent stages run concurrently
+
+        At most concurrency stages run in processes at once. When a stage
+        fails, stages depending on it (directly or not) are skipped,
+        while the rest of stages run to the end.
+    """
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, stages, concurrency=None):
+        self.stages = list(stages)
+        self.concurrency = max(1, int(concurrency or len(self.stages)))
+        names = set(stage.name for stage in self.stages)
+        for stage in self.stages:
+            unknown = set(stage.requires) - names
+            if unknown:
+                raise ValueError('Stage %s requires unknown stages %s' % (stage.name, ', '.join(unknown)))
+        self.results = {}
+
+    def run(self, abort_on_failure=True):
+        """ Run all stages, print timings, abort if any stage failed"""
+        finished = Queue()
+        pending = list(self.stages)
+        running = {}
+        started = time.time()
+
+        try:
+            while pending or running:
+                stage = self.pop_ready_stage(pending, len(running))
+                if stage is None and running:
+                    name, result = self.wait_finished(finished, running)
+                    running.pop(name).join()
+                    self.results[name] = result
+                elif stage is None and pending:
+                    raise ValueError('Stages %s have circular requirements' %
+                                     ', '.join(stage.name for stage in pending))
+                elif stage is None:
+                    continue  # the rest of stages were skipped
+                elif stage.in_process:
+                    self.results[stage.name] = self.run_stage(stage)
+                else:
+                    running[stage.name] = Process(target=self.run_forked_stage, args=(stage, finished))
+                    running[stage.name].start()
+        except BaseException:
+            for process in running.values():
+                process.terminate()
+            raise
+
+        self.report(time.time() - started)
+        if abort_on_failure and self.failed:
+            abort(red('Failed stages: %s' % ', '.join(self.failed)))
+        return self.results
+
+    @property
+    def failed(self):
+        return [stage.name for stage in self.stages if self.results[stage.name][0] == self.FAILED]
+
+    def pop_ready_stage(self, pending, running_count):
+        """ First stage, which can be started now. Stages after failed ones are marked skipped.
+
+            Stages run in processes go first, so they aren't held back
+            by in_process stages, which block the loop until they finish.
+        """
+        skipped = True
+        while skipped:  # skipped stage can be required by stages before it
+            ready, skipped = [], False
+            for stage in list(pending):
+                statuses = [self.results.get(name, (None,))[0] for name in stage.requires]
+                if any(status in (self.FAILED, self.SKIPPED) for status in statuses):
+                    pending.remove(stage)
+                    self.results[stage.name] = (self.SKIPPED, 0, None)
+                    skipped = True
+                elif all(status == self.DONE for status in statuses) and \
+                        (stage.in_process or running_count < self.concurrency):
+                    ready.append(stage)
+        ready.sort(key=lambda stage: stage.in_process)
+        if ready:
+            pending.remove(ready[0])
+            return ready[0]
+
+    def wait_finished(self, finished, running):
+        while True:
+            try:
+                return finished.get(timeout=self.POLL_INTERVAL)  # untimed get ignores Ctrl-C on python 2
+            except Empty:
+                for name, process in running.items():
+                    if process.exitcode:  # killed before it could report
+                        return name, (self.FAILED, 0, 'exit code %s' % process.exitcode)
+
+    def run_stage(self, stage):
+        started = time.time()
+        try:
+            stage.func()
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:  # abort() raises SystemExit
+            return self.FAILED, time.time() - started, None if isinstance(e, SystemExit) else repr(e)
+        return self.DONE, time.time() - started, None
+
+    def run_forked_stage(self, stage, finished):
+        # ssh connections of parent can't be shared, stage connects on its own
+        connections.clear()
+        finished.put((stage.name, self.run_stage(stage)))
+
+    def report(self, total_seconds):
+        colors = {self.DONE: green, self.FAILED: red, self.SKIPPED: yellow}
+        for stage in self.stages:
+            status, seconds, error = self.results[stage.name]
+            details = ' (%s)' % error if error else ''
+            puts(colors[status]('%-12s %-8s %6.1fs%s' % (stage.name, status, seconds, details)))
+        puts('Total: %.1fs' % total_seconds)
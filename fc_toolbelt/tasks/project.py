@@ -1,49 +1,85 @@
 # coding: utf-8
+import itertools
 import os
 from functools import partial
-from fabric.colors import green
+from fabric.colors import green, red
 
-from fabric.context_managers import cd, prefix
+from fabric.context_managers import cd, hide, prefix, settings
 from fabric.operations import run, sudo
-from fabric.state import env
+from fabric.state import connections, env
 from fabric.tasks import Task, execute
-from fabric.utils import puts
+from fabric.utils import abort, puts
 from fc_toolbelt.tasks.gitlab import BaseGitlabTask
 from fc_toolbelt.tasks.mysql import create_dev_db
+from fc_toolbelt.tasks.pipeline import Pipeline, Stage
 
-from .writers import write_uwsgi, write_nginx, write_project
+from .writers import write_uwsgi, write_nginx, write_project, ConfigUploader, WriteNginxConfig
 
 
 class OpenTin(BaseGitlabTask):
-    """ Commit new Django project from template into repo"""
+    """ Commit new Django project from template into repo
+
+        Template repo mirror and virtualenv with Django are kept in
+        BOILERPLATE_CACHE_PATH between runs: mirror is updated with git fetch,
+        virtualenv is rebuilt only when Django version pinned by template changes.
+    """
+    ENV_MARKER = '.fct-django'
 
     def run(self, project_slug):
         self.project_slug = project_slug
-        tmpdir = '/tmp/fctools/'
-        run('rm -rf /tmp/fctools/')
-        run('mkdir -p %s' % tmpdir)
+        cache_dir = env.get('BOILERPLATE_CACHE_PATH', '~/.fctools/boilerplate')
+        with hide('stdout'):
+            cache_dir = run('mkdir -p %(dir)s && cd %(dir)s && pwd' % {'dir': cache_dir}).strip()
+        tmpdir = '/tmp/fctools/%s/' % project_slug
+        run('rm -rf %(dir)s && mkdir -p %(dir)s' % {'dir': tmpdir})
 
-        self.create_folders_from_can(tmpdir)
+        self.create_folders_from_can(tmpdir, cache_dir)
         self.connect()
         repo_url = self.get_repo_url_by_path(project_slug)
         self.make_initial_commit(os.path.join(tmpdir, self.project_slug), repo_url)
-        run('rm -rf /tmp/fctools/')
+        run('rm -rf %s' % tmpdir)
 
-    def create_folders_from_can(self, dir):
-        """ Clone project template, make virtualenv, custom startproject"""
+    def create_folders_from_can(self, dir, cache_dir):
+        """ Update cached project template and virtualenv, custom startproject"""
+        template_dir = self.update_template(os.path.join(cache_dir, 'project_template'))
+        env_dir = self.update_env(os.path.join(cache_dir, 'canned_env'), self.get_django_requirement(template_dir))
         with cd(dir):
-            env_name = 'canned_env'
-            template_project_dirname = 'project_template'
-            run('git clone %(repo)s %(dir)s' % {'repo': env.TEMPLATE_PROJECT_REPO,
-                                                'dir': template_project_dirname})
-            run('virtualenv %s' % env_name)
-            with prefix('source %s/bin/activate' % env_name):
-                run('pip install django')
+            with prefix('source %s/bin/activate' % env_dir):
                 run('django-admin.py startproject %(project)s --template=%(template)s --extension=py,gitignore' % {
                     'project': self.project_slug,
-                    'template': os.path.join(template_project_dirname, env.TEMPLATE_PROJECT_PACKAGE),
+                    'template': os.path.join(template_dir, env.TEMPLATE_PROJECT_PACKAGE),
                 })
 
+    def update_template(self, template_dir):
+        """ Clone template repo once, then only fetch new commits"""
+        run('if [ -d %(dir)s/.git ]; then '
+            'cd %(dir)s && git remote set-url origin %(repo)s && git fetch --quiet origin '
+            '&& git reset --quiet --hard origin/HEAD && git clean --quiet -fdx; '
+            'else rm -rf %(dir)s && git clone --quiet %(repo)s %(dir)s; fi' % {
+                'repo': env.TEMPLATE_PROJECT_REPO, 'dir': template_dir})
+        return template_dir
+
+    def get_django_requirement(self, template_dir):
+        """ Django requirement pinned in template requirements files, or just "django" """
+        with settings(hide('stdout'), warn_only=True):
+            pinned = run("find %s -name 'requirements*.txt' -not -path '*/.git/*' | xargs -r cat "
+                         "| grep -iE '^django *([=<>!~]|$)' | head -1" % template_dir)
+        return pinned.strip().replace(' ', '') or 'django'
+
+    def update_env(self, env_dir, requirement):
+        """ Rebuild virtualenv only if Django requirement changed since last build"""
+        marker = os.path.join(env_dir, self.ENV_MARKER)
+        with settings(hide('stdout'), warn_only=True):
+            installed = run('cat %s' % marker)
+        if installed.succeeded and installed.strip() == requirement:
+            puts('Reusing cached virtualenv with %s' % requirement)
+            return env_dir
+        run('rm -rf %s' % env_dir)
+        run('virtualenv %s' % env_dir)
+        run("%s/bin/pip install '%s'" % (env_dir, requirement))
+        run("echo '%s' > %s" % (requirement, marker))
+        return env_dir
+
     def make_initial_commit(self, project_dir, repo_url):
         """ Init git repo and push it as current user """
         with cd(project_dir):
@@ -60,35 +96,108 @@ open_tin = OpenTin()
 
 
 class AddDeveloper(BaseGitlabTask):
-    """ Creates development project environment for developer"""
+    """ Creates development project environment for developer
+
+        Provisioning stages run concurrently where they don't depend
+        on each other: database doesn't wait for virtualenv, uwsgi config
+        waits only for project files, nginx config doesn't wait at all.
+        Interactive checkout and config rendering run in this process,
+        the rest of stages in their own processes (see Pipeline).
+        Configs are uploaded after all stages, pass uploader to collect
+        them and upload later.
+    """
     name = 'add_developer'
 
-    def run(self, project_slug, developer, uwsgi_config=None):
+    def run(self, project_slug, developer, uwsgi_config=None, noreload=False, uploader=None):
+        stages = self.prepare(project_slug, developer, noreload, uploader)
+        if env.host_string:
+            connections[env.host_string]  # ask for password once, forked stages inherit it
+        Pipeline(stages).run()
+        if uploader is None:
+            self.uploader.upload()
+        puts(green('Congrats! Now visit: %s' % ('http://%s.%s' % (project_slug, developer))))
+
+    def prepare(self, project_slug, developer, noreload=False, uploader=None, prefix=''):
+        """ Stages setting up the instance, names of stages start with prefix"""
         self.project_slug = project_slug
         self.developer = developer
+        self.noreload = noreload
+        self.uploader = uploader or ConfigUploader()
         self.connect()
-        repo_url = self.get_repo_url_by_path(project_slug)
-        self.setup_files(repo_url)
-        self.setup_databases()
-        self.setup_http()
-        puts(green('Congrats! Now visit: %s' % ('http://%s.%s' % (project_slug, developer))))
-
-    def setup_files(self, repo_url):
-        sudo_user = partial(sudo, user=self.developer)
-        sudo_user('mkdir -p %s' % env.PROJECTS_PATH_TEMPLATE % {'user': self.developer})
+        return self.get_stages(self.get_repo_url_by_path(project_slug), prefix)
+
+    def get_stages(self, repo_url, prefix=''):
+        name = lambda stage: prefix + stage
+        return [
+            Stage(name('checkout'), partial(self.checkout, repo_url), in_process=True),
+            Stage(name('files'), self.setup_files, requires=[name('checkout')]),
+            Stage(name('databases'), self.setup_databases),
+            Stage(name('uwsgi'), self.setup_uwsgi, requires=[name('files')], in_process=True),
+            Stage(name('nginx'), self.setup_nginx, in_process=True),
+        ]
+
+    def checkout(self, repo_url):
+        sudo('mkdir -p %s' % env.PROJECTS_PATH_TEMPLATE % {'user': self.developer}, user=self.developer)
         puts('Setting up new project "%s" for %s' % (self.project_slug, self.developer))
-        execute(write_project, project_slug=self.project_slug,
-                               developer=self.developer,
-                               repo_url=repo_url)
+        write_project.checkout(self.project_slug, self.developer, repo_url)
+
+    def setup_files(self):
+        with write_project.batched():
+            write_project.install(self.project_slug, self.developer)
         puts('Created project "%s" layout for %s' % (self.project_slug, self.developer))
 
     def setup_databases(self):
         execute(create_dev_db, self.project_slug, self.developer)
         puts('Setup of dev db "%s" for %s is finished' % (self.project_slug, self.developer))
 
-    def setup_http(self):
-        execute(write_uwsgi, self.project_slug, self.developer)
-        execute(write_nginx, self.project_slug, self.developer)
-        puts('Nginx+uwsgi are set up for "%s" project, developer %s' % (self.project_slug, self.developer))
+    def setup_uwsgi(self):
+        execute(write_uwsgi, self.project_slug, self.developer, uploader=self.uploader)
+
+    def setup_nginx(self):
+        execute(write_nginx, self.project_slug, self.developer, noreload=self.noreload, uploader=self.uploader)
 
 add_developer = AddDeveloper()
+
+
+class AddDevelopers(Task):
+    """ Creates dev instances for every developer in every project
+
+        Stages of all instances run in one pipeline, at most JOIN_CONCURRENCY
+        of them in processes at once. Interactive checkouts run one by one.
+        Configs of instances set up without failures are uploaded together
+        at the end, nginx config is checked and reloaded once, if any
+        of nginx configs changed.
+    """
+    name = 'add_developers'
+
+    def run(self, project_slugs, developers):
+        uploader = ConfigUploader()
+        stages, members, uploaders, failures = [], {}, {}, []
+        for member in itertools.product(project_slugs, developers):
+            prefix = '%s.%s/' % member
+            uploaders[member] = ConfigUploader()  # configs of failed instance are not uploaded
+            try:
+                members[member] = AddDeveloper().prepare(*member, noreload=True, uploader=uploaders[member],
+                                                         prefix=prefix)
+            except SystemExit:
+                failures.append(member)
+                continue
+            stages.extend(members[member])
+
+        if env.host_string:
+            connections[env.host_string]  # ask for password once, forked stages inherit it
+        results = Pipeline(stages, int(env.get('JOIN_CONCURRENCY', 4))).run(abort_on_failure=False)
+        failures.extend(member for member, member_stages in members.items()
+                        if any(results[stage.name][0] != Pipeline.DONE for stage in member_stages))
+        for member in members:
+            if member not in failures:
+                uploader.update(uploaders[member])
+
+        changed = uploader.upload()
+        if any(path.startswith(WriteNginxConfig.CONFIG_DIR) for path in changed):
+            sudo('nginx -t')
+            sudo(WriteNginxConfig.RELOAD_COMMAND)
+        if failures:
+            abort(red('Failed to set up: %s' % ', '.join('%s for %s' % member for member in sorted(failures))))
+
+add_developers = AddDevelopers()
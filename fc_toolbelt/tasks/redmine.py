@@ -1,13 +1,19 @@
 # coding: utf-8
+from datetime import datetime, timedelta
+import hashlib
 import json
+import os
+import time
 
 from fabric.colors import red, yellow, green
 from fabric.state import env
 from fabric.tasks import Task
 from fabric.utils import abort, puts
-from hammock import Hammock
 import requests
 
+from fc_toolbelt.tasks.api import Api
+from fc_toolbelt.tasks.utils import CachedDirectory, get_cache_path, parallel_map, report_results
+
 
 __all__ = ['create_project', 'assign_permissions']
 
@@ -27,9 +33,35 @@ class BaseRedmineTask(Task):
         if not REDMINE_API_KEY:
             abort(red('Go to %s/my/account and grab yourself a api key' % REDMINE_URL))
 
-        self.api = Hammock(env.REDMINE_URL,
-                           headers={'Content-Type': 'application/json',
-                                    'X-Redmine-API-Key': env.REDMINE_API_KEY})
+        self.api = Api(env.REDMINE_URL,
+                       headers={'Content-Type': 'application/json',
+                                'X-Redmine-API-Key': env.REDMINE_API_KEY})
+
+    def get_concurrency(self):
+        return int(env.get('REDMINE_CONCURRENCY', 8))
+
+    def get_all_pages(self, resource, key, limit=100, **params):
+        """ All objects of paginated resource (e.g. issues.json, users.json).
+
+            First page tells total_count, the rest of offsets are fetched
+            concurrently and reassembled in order. Stats of the last fetch
+            are kept in self.fetch_stats.
+        """
+        started = time.time()
+
+        def get_page(offset):
+            page_params = dict(params, limit=limit, offset=offset)
+            response = self.api(resource).GET(params=page_params)
+            if response.status_code == requests.codes.forbidden:
+                abort(red('Admin permissions required to read %s' % resource))
+            return response.json()
+
+        first_page = get_page(0)
+        offsets = range(limit, first_page.get('total_count', 0), limit)
+        pages = [first_page] + parallel_map(get_page, offsets, self.get_concurrency())
+
+        self.fetch_stats = {'pages': len(pages), 'seconds': time.time() - started}
+        return [obj for page in pages for obj in page[key]]
 
 
 class CreateProject(BaseRedmineTask):
@@ -50,61 +82,235 @@ class CreateProject(BaseRedmineTask):
 create_project = CreateProject()
 
 
+class UserDirectory(CachedDirectory):
+    """ Redmine users from all pages, indexed by mail and login
+
+        Cached on disk for REDMINE_DIRECTORY_TTL seconds.
+    """
+
+    def __init__(self, task, ttl=None):
+        self.task = task
+        super(UserDirectory, self).__init__(
+            get_cache_path('redmine', 'users-%s.json' % hashlib.sha1(env.REDMINE_URL.strip('/')).hexdigest()),
+            float(ttl or env.get('REDMINE_DIRECTORY_TTL', 300)))
+
+    def fetch(self):
+        return {'users': self.task.get_all_pages('users.json', 'users')}
+
+    def build_indexes(self, data):
+        self.users = data['users']
+        self.users_by_mail = dict((user['mail'].lower(), user) for user in self.users if user.get('mail'))
+        self.users_by_login = dict((user['login'], user) for user in self.users if user.get('login'))
+
+    def get_user(self, mail_or_login):
+        return self.lookup(lambda: self.users_by_mail.get(mail_or_login.lower()) or
+                                   self.users_by_login.get(mail_or_login))
+
+
 class AssignPermissions(BaseRedmineTask):
-    """ Add developers to project"""
+    """ Add developers to projects"""
     name = 'assign_permissions'
+    directory = None
+
+    ADDED = 'added'
+    PRESENT = 'already present'
+    FAILED = 'failed'
 
-    def run(self, project_slug, user_email):
+    def run(self, project_slug=None, user_email=None, assignments=None):
         """ Grant developer permission to user with specified email.
+
+            Many (project_slug, user_email) pairs can be passed as assignments,
+            memberships are posted concurrently.
         """
+        assignments = assignments or [(project_slug, user_email)]
         self.connect()
         developer_role_id = env.get('REDMINE_DEVELOPER_ROLE_ID', None)
         if not developer_role_id:
             abort(red('Please provide REDMINE_DEVELOPER_ROLE_ID setting'))
-        user_id = self.get_user_id_by_email(user_email)
+
+        results, memberships = [], []
+        for project_slug, user_email in assignments:
+            user = self.get_directory().get_user(user_email)
+            if user:
+                memberships.append((project_slug, user_email, user['id'], developer_role_id))
+            else:
+                results.append((self.FAILED, 'No user with email %s' % user_email))
+        results += parallel_map(self.add_member, memberships, self.get_concurrency())
+
+        report_results(results, [(self.ADDED, green), (self.PRESENT, yellow), (self.FAILED, red)],
+                       failed=self.FAILED, noun='membership')
+
+    def add_member(self, membership):
+        project_slug, user_email, user_id, role_id = membership
         response = self.api('projects/%s/memberships.json' % project_slug).POST(data=json.dumps({
             'membership': {
                 'user_id': user_id,
-                'role_ids': [developer_role_id]
+                'role_ids': [role_id]
             }
         }))
-        if response.status_code == requests.codes.ok:
-            puts('User %s added to project %s' % (user_email, project_slug))
+        if response.status_code in (requests.codes.ok, requests.codes.created):
+            return self.ADDED, 'User %s added to project %s' % (user_email, project_slug)
+        elif response.status_code == requests.codes.unprocessable:
+            return self.PRESENT, 'User %s is already a member of %s' % (user_email, project_slug)
+        return self.FAILED, 'User %s not added to %s: %s' % (user_email, project_slug, response.content)
+
+    def get_directory(self):
+        if self.directory is None:
+            self.directory = UserDirectory(self)
+        return self.directory
 
     def get_user_id_by_email(self, user_email):
-        response = self.api('users.json').GET()
-        if response.status_code == 403:
-            abort(red('Admin permissions required'))
-        users = response.json['users']
-        user = filter(lambda u: u['mail'] == user_email, users)
+        user = self.get_directory().get_user(user_email)
         if not user:
             abort(red('No user with email %s' % user_email))
-        return user[0]['id']
+        return user['id']
 
 assign_permissions = AssignPermissions()
 
 
+class IssueCache(object):
+    """ Issues of one Redmine instance stored on disk
+
+        Every entry keeps issue json, its updated_on and last access time,
+        least recently used entries are evicted when cache exceeds max_size.
+    """
+
+    def __init__(self, redmine_url, max_size=None):
+        self.path = get_cache_path('redmine', '%s.json' % hashlib.sha1(redmine_url).hexdigest())
+        self.max_size = int(max_size or env.get('REDMINE_CACHE_SIZE', 5000))
+        self.synced_at = None
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+            self.synced_at = data['synced_at']
+            self.entries = data['issues']
+
+    def get(self, issue_id):
+        entry = self.entries.get(str(issue_id))
+        if entry:
+            entry['used'] = time.time()
+            return entry['issue']
+
+    def update(self, issues):
+        now = time.time()
+        for issue in issues:
+            issue_id = str(issue['id'])
+            self.entries[issue_id] = {'issue': issue,
+                                      'updated_on': issue.get('updated_on'),
+                                      'used': self.entries.get(issue_id, {}).get('used', now)}
+
+    def save(self):
+        if len(self.entries) > self.max_size:
+            by_usage = sorted(self.entries, key=lambda issue_id: self.entries[issue_id]['used'])
+            for issue_id in by_usage[:len(self.entries) - self.max_size]:
+                del self.entries[issue_id]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'synced_at': self.synced_at, 'issues': self.entries}, cache_file)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        self.synced_at = None
+        self.entries = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class GetIssues(BaseRedmineTask):
-    """ Get all issues, abstracting pagination"""
+    """ Get all issues, abstracting pagination
+
+        Call enable_cache after connect to read issues by ids through local IssueCache.
+        Query results (get_issues) always come from Redmine: a filtered query
+        can't be answered from cache, so it neither reads nor fills it.
+    """
+    MAX_IDS_PER_QUERY = 100  # Redmine won't return more than 100 issues per page
+    MAX_IDS_QUERY_LENGTH = 1500  # keeps issue_id=1,2,3... well below url length limits
+    cache = None
 
     def run(self, **kwargs):
         """ Example kwargs: project_id, query_id"""
         self.connect()
         return self.get_issues(**kwargs)
 
-    def get_issues(self, **kwargs):
+    def enable_cache(self, max_size=None, clear=False):
+        self.cache = IssueCache(env.REDMINE_URL.strip('/'), max_size)
+        if clear:
+            self.cache.clear()
+        self.revalidate_cache()
+
+    def revalidate_cache(self):
+        """ Refresh cached issues changed since last sync with a single query"""
+        # a bit earlier than now, in case our clock is ahead of Redmine's
+        sync_started = (datetime.utcnow() - timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if self.cache.synced_at and self.cache.entries:
+            changed_issues = self.get_all_pages('issues.json', 'issues',
+                                                status_id='*',
+                                                updated_on='>=%s' % self.cache.synced_at)
+            self.cache.update(issue for issue in changed_issues if str(issue['id']) in self.cache.entries)
+        self.cache.synced_at = sync_started
+        self.cache.save()
+
+    def get_issues(self, limit=100, **kwargs):
         """ Issue dicts """
-        offset = 0
-        limit = 100
-        issues, total_count = self.get_issues_page(offset, limit, **kwargs)
-        while offset + limit < total_count:
-            offset += limit
-            new_issues, total_count = self.get_issues_page(offset, **kwargs)
-            issues += new_issues
-        return issues
-
-    def get_issues_by_ids(self, issue_ids):
-        return [self.get_issue_by_id(issue_id)['issue'] for issue_id in issue_ids]
+        return self.get_all_pages('issues.json', 'issues', limit=limit, **kwargs)
+
+    def get_issues_by_ids(self, issue_ids, batched=True):
+        """ Issue dicts in order of issue_ids, missing/forbidden issues are skipped.
+
+            Batched lookup asks for many ids per request with issue_id filter
+            and falls back to single issue requests only for ids bulk query
+            didn't return.
+        """
+        started = time.time()
+        issue_ids = [str(issue_id) for issue_id in issue_ids]
+        found = {}
+        requests_count = 0
+        if self.cache:
+            for issue_id in issue_ids:
+                issue = self.cache.get(issue_id)
+                if issue:
+                    found[issue_id] = issue
+        cached_ids = set(found)
+
+        if batched:
+            chunks = self.chunk_issue_ids([issue_id for issue_id in issue_ids if issue_id not in found])
+            for issues in parallel_map(self.get_issues_chunk, chunks, self.get_concurrency()):
+                found.update((str(issue['id']), issue) for issue in issues)
+            requests_count += len(chunks)
+
+        missing_ids = [issue_id for issue_id in issue_ids if issue_id not in found]
+        for issue in parallel_map(self.get_issue_or_none, missing_ids, self.get_concurrency()):
+            if issue:
+                found[str(issue['id'])] = issue
+        requests_count += len(missing_ids)
+
+        if self.cache:
+            self.cache.update(issue for issue_id, issue in found.items() if issue_id not in cached_ids)
+            self.cache.save()
+
+        self.fetch_stats = {'pages': requests_count, 'seconds': time.time() - started,
+                            'cached': len(cached_ids)}
+        return [found[issue_id] for issue_id in issue_ids if issue_id in found]
+
+    def chunk_issue_ids(self, issue_ids):
+        """ Split ids into comma-separated chunks fitting a single query"""
+        chunks, chunk = [], []
+        for issue_id in issue_ids:
+            if chunk and (len(chunk) == self.MAX_IDS_PER_QUERY or
+                          len(','.join(chunk + [issue_id])) > self.MAX_IDS_QUERY_LENGTH):
+                chunks.append(','.join(chunk))
+                chunk = []
+            chunk.append(issue_id)
+        if chunk:
+            chunks.append(','.join(chunk))
+        return chunks
+
+    def get_issues_chunk(self, ids_chunk):
+        params = {'issue_id': ids_chunk,
+                  'status_id': '*',  # closed issues too
+                  'limit': self.MAX_IDS_PER_QUERY}
+        return self.api('issues.json').GET(params=params).json()['issues']
 
     def get_issues_page(self, offset=0, limit=100, **kwargs):
         params = {'limit': limit, 'offset': offset}
@@ -115,5 +321,11 @@ class GetIssues(BaseRedmineTask):
     def get_issue_by_id(self, issue_id):
         return self.api.issues('%s.json' % issue_id).GET().json()
 
+    def get_issue_or_none(self, issue_id):
+        response = self.api.issues('%s.json' % issue_id).GET()
+        if response.status_code != requests.codes.ok:
+            return None
+        return response.json()['issue']
+
     def get_issue_title(self, issue_id):
         return self.get_issue_by_id(issue_id)['subject']
@@ -1,11 +1,10 @@
 # coding: utf-8
 from __future__ import print_function
 import logging
-from fabric.operations import local
 
 from fabric.state import env
 from fabric.utils import puts
-from fc_toolbelt.tasks.git import get_branch
+from fc_toolbelt.tasks.git import get_branch, CommitTicketIndex, TicketExtractor
 
 from fc_toolbelt.tasks.redmine import GetIssues
 
@@ -17,18 +16,26 @@ class DiffTickets(GetIssues):
     """ List of Redmine tickets urls, mentioned in commits that differ between two branches/tags.
     """
     name = 'tickets'
-    GIT_CALL = """git log {from_ref} --not {to_ref} --format="%s" --no-merges | grep -E "#\d+" -o | cut -c2- """
 
-    def run(self, from_ref='origin/dev', to_ref='origin/master', **kwargs):
+    def run(self, from_ref='origin/dev', to_ref='origin/master', concurrency=None,
+            no_cache=False, clear_cache=False, cache_size=None, patterns=None, no_index=False, **kwargs):
+        if concurrency:
+            env.REDMINE_CONCURRENCY = concurrency
 
-        ticket_ids = set(filter(None, self.git_ticket_ids(from_ref, to_ref)))
+        ticket_ids = self.git_ticket_ids(from_ref, to_ref, patterns, use_index=not no_index)
 
         self.connect()
+        if kwargs.get('by_ids') and not no_cache:
+            self.enable_cache(max_size=cache_size, clear=clear_cache)
         puts('Querying Redmine...')
         if kwargs.get('by_ids'):
-            issues = self.get_issues_by_ids(ticket_ids)
+            issues = self.get_issues_by_ids(ticket_ids, batched=not kwargs.get('no_batch'))
         else:
             issues = self.get_issues(**kwargs)
+        puts('Fetched %s issues in %.2fs (%s pages, %s from cache)' % (len(issues),
+                                                                      self.fetch_stats['seconds'],
+                                                                      self.fetch_stats['pages'],
+                                                                      self.fetch_stats.get('cached', 0)))
 
         logger.debug('%s: %s' % ('Redmine', [issue['id'] for issue in issues]))
         logger.debug('%s: %s' % ('Git', ticket_ids))
@@ -51,12 +58,13 @@ class DiffTickets(GetIssues):
         issues_urls = [formatter(issue) for issue in issues if str(issue['id']) in ticket_ids]
         map(print, issues_urls)
 
-    def git_ticket_ids(self, from_ref, to_ref):
-        """ List of ids"""
-        from_ref = get_branch.run(from_ref)
-        to_ref = get_branch.run(to_ref)
-        git_log_output = local(self.GIT_CALL.format(from_ref=from_ref, to_ref=to_ref), capture=True)
-        return git_log_output.split('\n')
+    def git_ticket_ids(self, from_ref, to_ref, patterns=None, use_index=True):
+        """ Set of ids"""
+        from_ref, to_ref = get_branch.resolve(from_ref, to_ref)
+        extractor = TicketExtractor(patterns)
+        if use_index:
+            return CommitTicketIndex(extractor).git_ticket_ids(from_ref, to_ref)
+        return extractor.git_ticket_ids(from_ref, to_ref)
 
 
 diff_tickets = DiffTickets()
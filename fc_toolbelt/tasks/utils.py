@@ -0,0 +1,121 @@
+# coding: utf-8
+import json
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from fabric.colors import red
+from fabric.state import env
+from fabric.utils import abort, puts
+
+
+def get_cache_path(*parts):
+    """ Path inside local toolbelt cache dir, parent dirs are created.
+
+        Cache dir lives next to .fabricrc, TOOLBELT_CACHE_DIR overrides it.
+    """
+    cache_dir = os.path.expanduser(env.get('TOOLBELT_CACHE_DIR', '~/.fc_toolbelt'))
+    path = os.path.join(cache_dir, *parts)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+
+def parallel_map(func, items, concurrency=8):
+    """ Like map(), but calls func in a bounded pool of threads.
+
+        Results are returned in the order of items. The first exception
+        raised by func (including fabric's abort, which is SystemExit)
+        is re-raised in the calling thread.
+    """
+    items = list(items)
+    concurrency = max(1, min(int(concurrency), len(items)))
+    if concurrency == 1:
+        return map(func, items)
+
+    def call(item):
+        # SystemExit would silently kill a pool worker and hang map()
+        try:
+            return True, func(item)
+        except BaseException:
+            return False, sys.exc_info()
+
+    pool = ThreadPool(concurrency)
+    try:
+        pending = pool.map_async(call, items)
+        while not pending.ready():
+            pending.wait(0.5)  # untimed wait can't be interrupted by Ctrl-C on python 2
+        results = pending.get()
+    except BaseException:
+        pool.terminate()  # workers are daemon threads, don't wait for their requests
+        raise
+    pool.close()
+    pool.join()
+
+    values = []
+    for ok, value in results:
+        if not ok:
+            raise value[0], value[1], value[2]
+        values.append(value)
+    return values
+
+
+class CachedDirectory(object):
+    """ Objects fetched from an API, kept on disk for ttl seconds
+
+        Subclasses implement fetch(), returning a dict of json-able lists,
+        and build_indexes(data). On lookup miss stale data is refetched once,
+        so freshly created objects are found.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.is_fresh = False
+        data = None
+        if os.path.exists(self.path):
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        if data and time.time() - data['fetched_at'] < self.ttl:
+            self.build_indexes(data)
+        else:
+            self.refresh()
+
+    def fetch(self):
+        raise NotImplementedError
+
+    def build_indexes(self, data):
+        raise NotImplementedError
+
+    def refresh(self):
+        data = self.fetch()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(dict(data, fetched_at=time.time()), cache_file)
+        os.rename(tmp_path, self.path)
+        self.build_indexes(data)
+        self.is_fresh = True
+
+    def lookup(self, find):
+        """ Result of find(), which is retried once on fresh data if it's None"""
+        result = find()
+        if result is None and not self.is_fresh:
+            self.refresh()
+            result = find()
+        return result
+
+
+def report_results(results, colors, failed, noun):
+    """ Print (status, message) results and counts of statuses, abort if any of them failed
+
+        colors are (status, color) pairs in order of summary.
+    """
+    colors = list(colors)
+    for status, message in results:
+        puts(dict(colors)[status](message))
+    counts = [(status, len([result for result in results if result[0] == status])) for status, color in colors]
+    summary = ', '.join('%s: %s' % count for count in counts)
+    puts(summary[0].upper() + summary[1:])
+    if dict(counts)[failed]:
+        abort(red('%s %s(s) failed' % (dict(counts)[failed], noun)))
@@ -1,17 +1,210 @@
 # coding: utf-8
+from contextlib import contextmanager
+import hashlib
 from os.path import join, dirname
+from pipes import quote
+import re
 import socket
-from functools import partial
-from fabric.context_managers import cd, settings, show
-from fabric.contrib.files import upload_template
+from StringIO import StringIO
+import tarfile
+import threading
+import time
+import uuid
+from fabric.colors import red
+from fabric.context_managers import hide, settings, show
+from jinja2 import Environment, FileSystemLoader
 
-from fabric.operations import sudo, run
+from fabric.operations import put, sudo, run
 from fabric.state import env
 from fabric.tasks import Task
-from fabric.utils import puts
+from fabric.utils import abort, puts
+
+
+class RemoteBatch(object):
+    """ Remote commands collected into one script, run by a single sudo
+
+        Script runs with set -e, commands of other users are wrapped into
+        sudo -u. Fabric's cd is not applied, batched commands use absolute paths.
+        Every command is preceded by a marker, so the failed one is known.
+    """
+    MARKER = 'fct-step'
+
+    def __init__(self):
+        self.steps = []
+
+    def add(self, command, user=None):
+        self.steps.append((command, user))
+
+    def get_script(self):
+        lines = ['set -e']
+        for index, (command, user) in enumerate(self.steps):
+            if user:
+                command = 'sudo -u %s bash -lc %s' % (quote(user), quote(command))
+            lines += ['echo %s %s' % (self.MARKER, index), command]
+        return '\n'.join(lines)
+
+    def run(self):
+        if not self.steps:
+            return
+        steps, self.steps = self.steps, []
+        result = sudo('bash -c %s' % quote(self.get_script()), warn_only=True)
+        if result.failed:
+            started = re.findall(r'^%s (\d+)' % self.MARKER, result, re.MULTILINE)
+            command, user = steps[int(started[-1]) if started else 0]
+            abort(red('Remote step failed (as %s): %s' % (user or 'root', command)))
+        return result
+
+
+_jinja_env = None
+
+
+def get_jinja_env():
+    """ One jinja environment, so templates are compiled once per process"""
+    global _jinja_env
+    if _jinja_env is None:
+        _jinja_env = Environment(loader=FileSystemLoader(join(dirname(dirname(__file__)), 'config_templates/')))
+    return _jinja_env
+
+
+VENV_CACHE_SCRIPT = """set -e
+cache=%(cache)s
+mkdir -p "$cache/envs" "$cache/pip" "$cache/downloads"
+chgrp %(group)s "$cache/pip" "$cache/downloads" && chmod 2775 "$cache/pip" "$cache/downloads"
+key=$( (%(python)s -V 2>&1; cat %(requirements)s) | sha1sum | cut -c1-40)
+rm -rf %(env_path)s  # env of previous join, virtualenv-clone won't overwrite it
+if [ -d "$cache/envs/$key" ]; then
+    echo "Using cached virtualenv $key"
+    touch "$cache/envs/$key"
+    virtualenv-clone "$cache/envs/$key" %(env_path)s
+    echo %(project_path)s > %(env_path)s/.project
+    chown -R %(user)s:%(group)s %(env_path)s
+else
+    sudo -u %(user)s bash -lc %(mkenv)s fct "$cache"
+    tmp=$(mktemp -d "$cache/envs/.$key.XXXXXX")  # hidden from ls, so never evicted
+    trap 'rm -rf "$tmp"' EXIT
+    virtualenv-clone %(env_path)s "$tmp/env"
+    mv -T "$tmp/env" "$cache/envs/$key" 2>/dev/null || echo "Virtualenv $key is already cached"
+    while [ $(ls "$cache/envs" | wc -l) -gt 1 ] && [ $(du -sm "$cache/envs" | cut -f1) -gt %(cache_size)s ]; do
+        rm -rf "$cache/envs/$(ls -t "$cache/envs" | tail -n 1)"
+    done
+fi"""
+
+
+class ConfigUploader(object):
+    """ Configs uploaded only if their content differs from remote files
+
+        Remote files are hashed with one command, changed ones are packed
+        into one archive, put with a single sftp transfer and unpacked
+        with one sudo, which also runs on_change commands of changed
+        configs (each distinct command once, e.g. nginx reload).
+        Commands passed as always run on every upload, even if nothing
+        changed, so they must be idempotent (e.g. ln -fs).
+    """
+
+    def __init__(self):
+        self.configs = {}
+        self.lock = threading.Lock()
+
+    def add(self, path, content, on_change=None, always=None):
+        with self.lock:
+            self.configs[path] = (content.encode('utf-8') if isinstance(content, unicode) else content,
+                                  on_change, always)
+
+    def update(self, uploader):
+        """ Take configs collected by another uploader"""
+        with self.lock:
+            self.configs.update(uploader.configs)
+
+    def get_remote_hashes(self, paths):
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            output = sudo('sha1sum %s 2>/dev/null' % ' '.join(quote(path) for path in paths))
+        hashes = {}
+        for line in output.splitlines():
+            parts = line.strip().split(None, 1)
+            if len(parts) == 2:
+                hashes[parts[1]] = parts[0]
+        return hashes
+
+    def upload(self):
+        """ Paths of changed configs"""
+        with self.lock:
+            configs, self.configs = self.configs, {}
+        if not configs:
+            return []
+        remote_hashes = self.get_remote_hashes(sorted(configs))
+        changed = [path for path in sorted(configs)
+                   if remote_hashes.get(path) != hashlib.sha1(configs[path][0]).hexdigest()]
+        always = []
+        for path in sorted(configs):
+            if configs[path][2] and configs[path][2] not in always:
+                always.append(configs[path][2])
+        if not changed:
+            if always:
+                sudo(' && '.join(always))
+            puts('Configs are up to date')
+            return changed
+
+        archive = StringIO()
+        tar = tarfile.open(fileobj=archive, mode='w:gz')
+        for path in changed:
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(configs[path][0])
+            info.mode = 0644
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(configs[path][0]))
+        tar.close()
+        archive.seek(0)
+
+        remote_archive = '/tmp/fct-configs-%s.tar.gz' % uuid.uuid4().hex
+        put(archive, remote_archive)
+        commands = ['tar -xzf %s -C / --no-same-owner' % remote_archive, 'rm -f %s' % remote_archive] + always
+        for path in changed:
+            on_change = configs[path][1]
+            if on_change and on_change not in commands:
+                commands.append(on_change)
+        sudo(' && '.join(commands))
+        puts('Updated configs: %s' % ', '.join(changed))
+        return changed
 
 
 class BaseWriterTask(Task):
+    """ Base for tasks writing files on dev server
+
+        Tasks with batch_remote_commands (or BATCH_REMOTE_COMMANDS setting)
+        send commands issued with self.sudo in batches within
+        self.batched() block, see RemoteBatch.
+    """
+    batch_remote_commands = False
+    _batches = threading.local()  # writers are module-level singletons
+
+    def sudo(self, command, user=None):
+        batch = getattr(self._batches, 'current', None)
+        if batch is not None:
+            batch.add(command, user)
+        else:
+            return sudo(command, user=user)
+
+    def flush(self):
+        """ Run commands batched so far, e.g. before interactive command"""
+        batch = getattr(self._batches, 'current', None)
+        if batch is not None:
+            batch.run()
+
+    @contextmanager
+    def batched(self):
+        if not (self.batch_remote_commands or env.get('BATCH_REMOTE_COMMANDS')):
+            yield
+            return
+        self._batches.current = RemoteBatch()
+        try:
+            yield
+            self._batches.current.run()
+        finally:
+            self._batches.current = None
+
+    def render(self, template_file, context):
+        return get_jinja_env().get_template(template_file).render(**context)
+
     def get_template_path(self, template_file=None):
         base_path = join(dirname(dirname(__file__)), 'config_templates/')
         if template_file:
@@ -41,39 +234,100 @@ class WriteProjectFolders(BaseWriterTask):
     """
     name = 'write_project'
 
-    def run_chmod(self, project_slug, developer):
-        sudo('chown -R {user}:{group} {project}'.format(
+    batch_remote_commands = True
+
+    def run_chmod(self, project_path, developer):
+        self.sudo('chown -R {user}:{group} {project}'.format(
             user=developer,
             group=env.DEVELOPERS_USERGROUP,
-            project=project_slug)
+            project=project_path)
         )
-        sudo('chmod -R 755 {project}'.format(user=developer, project=project_slug))
-
-    def copy_repo_files_install_env(self, project_slug, project_path, repo_url):
-        """ workaround not having permissions in target dir to clone directly"""
-        tmp_dir = '/tmp/fctools/%s' % project_slug
-        sudo('rm -rf %s' % tmp_dir)
-        with settings(show('commands'), warn_only=True):  # so that you can enter credentials
-            run('git clone %s %s -b dev' % (repo_url, tmp_dir))  # dev branch is default
-        sudo('rm -rf %s/.git' % tmp_dir)
-        sudo('cp -R %s/* %s' % (tmp_dir, project_path))
-        sudo('rm -rf %s' % tmp_dir)
+        self.sudo('chmod -R 755 {project}'.format(project=project_path))
+
+    def copy_repo_files_install_env(self, project_slug, project_path, repo_url, developer):
+        """ Put snapshot of dev branch into project dir, without history.
+
+            Code is fetched as connecting user, with their git credentials,
+            into an empty temp dir and then copied over project dir.
+            CHECKOUT_MODE=archive (default) streams git archive from the repo
+            server, falling back to clone mode when server doesn't allow it
+            (Gitlab over ssh usually doesn't). CHECKOUT_MODE=clone makes
+            a shallow single-branch clone. Both are interactive,
+            so that you can enter credentials.
+        """
+        branch = env.get('CHECKOUT_BRANCH', 'dev')  # dev branch is default
+        self.flush()
+        with hide('stdout'):
+            tmp_dir = run('mktemp -d /tmp/fct-checkout.XXXXXX').strip()
+        with settings(show('commands'), warn_only=True):
+            result = None
+            if env.get('CHECKOUT_MODE', 'archive') == 'archive':
+                result = run('set -o pipefail; git archive --format=tar --remote=%s %s | tar -x -C %s' % (
+                    repo_url, branch, tmp_dir))
+                if result.failed:
+                    puts('git archive is not available, making shallow clone')
+                    run('rm -rf %(dir)s && mkdir %(dir)s' % {'dir': tmp_dir})  # drop partial output
+            if result is None or result.failed:
+                result = run('git clone --depth 1 --single-branch -b %s %s %s' % (branch, repo_url, tmp_dir))
+        if result.failed:
+            run('rm -rf %s' % tmp_dir)
+            abort(red('Failed to check out %s branch of %s' % (branch, repo_url)))
+        run('rm -rf %s/.git' % tmp_dir)
+        self.sudo('cp -R %s/. %s' % (tmp_dir, project_path))
+        self.sudo('rm -rf %s' % tmp_dir)
+
+    def get_cached_env_script(self, project_slug, developer, mkenv_command):
+        """ Clone prebuilt virtualenv with same python and requirements.txt, or build and store it.
+
+            Envs are kept in VENV_CACHE_PATH by sha1 of python version and
+            requirements, least recently used are removed when cache grows
+            over VENV_CACHE_SIZE_MB. Pip cache (built wheels) is shared between
+            developers. Existing env of the project is rebuilt, so it matches
+            requirements. Needs virtualenv-clone on the server.
+        """
+        project_path = self.get_project_path(project_slug, developer)
+        return VENV_CACHE_SCRIPT % {
+            'cache': quote(env.VENV_CACHE_PATH.rstrip('/')),
+            'cache_size': int(env.get('VENV_CACHE_SIZE_MB', 5120)),
+            'group': quote(env.DEVELOPERS_USERGROUP),
+            'user': quote(developer),
+            'python': quote('python%s' % env.get('PYTHON_VERSION', '2.7')),
+            'requirements': quote(join(project_path, 'requirements.txt')),
+            'project_path': quote(project_path),
+            'env_path': quote(self.get_env_path(project_slug, developer)),
+            'mkenv': quote('export PIP_CACHE_DIR="$1/pip" PIP_DOWNLOAD_CACHE="$1/downloads"; ' + mkenv_command),
+        }
 
     def run(self, project_slug, developer, repo_url=None):
-        self.user_sudo = user_sudo = partial(sudo, user=developer)
+        with self.batched():
+            self.write_project(project_slug, developer, repo_url)
+
+    def write_project(self, project_slug, developer, repo_url=None):
+        self.checkout(project_slug, developer, repo_url)
+        self.install(project_slug, developer)
+
+    def checkout(self, project_slug, developer, repo_url=None):
+        """ Project dir with code, interactive if repo_url is given"""
         project_path = self.get_project_path(project_slug, developer)
-        user_sudo('mkdir -p %s' % project_path)
+        self.sudo('mkdir -p %s' % project_path, user=developer)
         if repo_url:
-            self.copy_repo_files_install_env(project_slug, project_path, repo_url)
+            self.copy_repo_files_install_env(project_slug, project_path, repo_url, developer)
+
+    def install(self, project_slug, developer):
+        """ Virtualenv with project requirements, permissions"""
+        user_sudo = lambda command: self.sudo(command, user=developer)
+        project_path = self.get_project_path(project_slug, developer)
         mkenv_command = 'mkvirtualenv --python=python%(version)s -a %(project_path)s -r %(reqs)s %(env_name)s'
-        user_sudo(mkenv_command % {'version': env.get('PYTHON_VERSION', '2.7'),
-                                   'project_path': self.get_project_path(project_slug, developer),
-                                   'reqs': 'requirements.txt',
-                                   'env_name': project_slug})
-        with cd(env.ENVS_PATH_TEMPLATE % {'user': developer}):
-            user_sudo('touch %s/reload.txt' % project_slug)
-        with cd(env.PROJECTS_PATH_TEMPLATE % ({'user': developer})):
-            self.run_chmod(project_slug, developer)
+        mkenv_command %= {'version': env.get('PYTHON_VERSION', '2.7'),
+                          'project_path': project_path,
+                          'reqs': join(project_path, 'requirements.txt'),
+                          'env_name': project_slug}
+        if env.get('VENV_CACHE_PATH'):
+            self.sudo('bash -c %s' % quote(self.get_cached_env_script(project_slug, developer, mkenv_command)))
+        else:
+            user_sudo(mkenv_command)
+        user_sudo('touch %s' % join(self.get_env_path(project_slug, developer), 'reload.txt'))
+        self.run_chmod(project_path, developer)
 
 write_project = WriteProjectFolders()
 
@@ -94,24 +348,25 @@ class WriteUwsgiConfig(BaseWriterTask):
             'PROJECT_NAME': project_slug,
         }
 
-    def run(self, project_slug, developer):
+    def run(self, project_slug, developer, uploader=None):
+        """ Config is uploaded only if changed, but always linked into apps-enabled of PYTHON_VERSION.
+            Pass uploader to upload it later with other configs.
+        """
         config_name = self.get_server_name(project_slug, developer)
         config_available_path = '/etc/uwsgi/apps-available/%s.ini' % config_name
         config_enabled_path = '/etc/uwsgi/apps-enabled-%s/%s.ini' % (env.get('PYTHON_VERSION', '2.7'), config_name)
 
-        upload_template(
-            template_dir=self.get_template_path(),
-            filename=env.get('UWSGI_CONFIG_TEMPLATE', 'uwsgi.config.tmpl'),
-            destination=config_available_path,
-            context=self.get_context(project_slug, developer),
-            use_sudo=True,
-            use_jinja=True,
-            backup=False
-        )
-        sudo('ln -fs %(available)s %(enabled)s' % {
-            'available': config_available_path,
-            'enabled': config_enabled_path
-        })
+        own_uploader = uploader is None
+        uploader = uploader or ConfigUploader()
+        uploader.add(config_available_path,
+                     self.render(env.get('UWSGI_CONFIG_TEMPLATE', 'uwsgi.config.tmpl'),
+                                 self.get_context(project_slug, developer)),
+                     always='ln -fs %(available)s %(enabled)s' % {
+                         'available': config_available_path,
+                         'enabled': config_enabled_path
+                     })
+        if own_uploader:
+            uploader.upload()
 
 write_uwsgi = WriteUwsgiConfig()
 
@@ -119,6 +374,8 @@ write_uwsgi = WriteUwsgiConfig()
 class WriteNginxConfig(BaseWriterTask):
     """ Write nginx config for project+developer and reload nginx"""
     name = 'write_nginx'
+    CONFIG_DIR = '/etc/nginx/fc/'
+    RELOAD_COMMAND = '/etc/init.d/nginx reload'
 
     def get_context(self, project_slug, developer):
         server_name = self.get_server_name(project_slug, developer)
@@ -130,19 +387,18 @@ class WriteNginxConfig(BaseWriterTask):
             'PROJECT_NAME': project_slug,
         }
 
-    def run(self, project_slug, developer, noreload=False):
+    def run(self, project_slug, developer, noreload=False, uploader=None):
+        """ Config is uploaded and nginx reloaded only if config changed,
+            pass uploader to upload it later with other configs.
+        """
         context = self.get_context(project_slug, developer)
-        upload_template(
-            template_dir=self.get_template_path(),
-            filename='nginx.config.tmpl',
-            destination='/etc/nginx/fc/%s' % self.get_server_name(project_slug, developer),
-            context=context,
-            use_jinja=True,
-            use_sudo=True,
-            backup=False
-        )
-        if not noreload:
-            sudo('/etc/init.d/nginx reload')
+        own_uploader = uploader is None
+        uploader = uploader or ConfigUploader()
+        uploader.add(join(self.CONFIG_DIR, self.get_server_name(project_slug, developer)),
+                     self.render('nginx.config.tmpl', context),
+                     on_change=None if noreload else self.RELOAD_COMMAND)
+        if own_uploader:
+            uploader.upload()
         puts('Add this lines to your /etc/hosts:')
         puts('%(ip)s   %(project_domain)s' % {'ip': context['SERVER_IP'], 'project_domain': context['SERVER_NAME']})
         puts('%(ip)s   *.%(project_domain)s.fcdev.ru' % {'ip': context['SERVER_IP'], 'project_domain': context['SERVER_NAME']})
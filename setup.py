@@ -11,8 +11,7 @@ setup(
         'fabric>=1.5',
         'fabric-taskset==0.2.1',
         'docopt>=0.6.1',
-        'hammock==0.2.4',
-        'jenkinsapi==0.2.6',
+        'requests>=1.2',
         'Jinja2==2.7',
     ],
     entry_points={